@@ -28,8 +28,8 @@ class Architect(object):
                                           lr=args.arch_learning_rate, betas=(0.5, 0.999),
                                           weight_decay=args.arch_weight_decay)
         if self.args.use_beta:
-            self.anchor_arch = Dirichlet(torch.ones_like(self.model.arch_weights).cuda())
-            self.anchor_arch2 = Dirichlet(torch.ones_like(self.model.arch_weights2).cuda())
+            self.anchor_arch = Dirichlet(torch.ones_like(self.model.arch_weights))
+            self.anchor_arch2 = Dirichlet(torch.ones_like(self.model.arch_weights2))
 
     def step(self, examples, unrolled=False, epochs=100, data_iter_step=1, accum_iter=2, epoch_step=0, search_step=0):
         self.optimizer.zero_grad()
@@ -6,7 +6,8 @@ import time
 import utils.misc as misc
 import utils.lr_sched as lr_sched
 
-from lora.lora import weights
+from space.t5_search_space import weights
+from examples_seq2seq.data_processors import AutoTask
 
 
 def train_one_epoch(model, epoch, train_loader, eval_loader, optimizer, scaler,
@@ -54,6 +55,7 @@ def train_one_epoch(model, epoch, train_loader, eval_loader, optimizer, scaler,
                     lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(train_loader) + epoch, args)
 
         loss_search = None
+        step_start = time.time()
 
         if use_search and not retrain_mode:
             trn_input, val_input = inputs, val_data_list[r%len(val_data_list)]
@@ -108,8 +110,12 @@ def train_one_epoch(model, epoch, train_loader, eval_loader, optimizer, scaler,
         if scheduler is not None:
             scheduler.step()
 
-        torch.cuda.synchronize()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
 
+        # source + target tokens per second of the whole step (search step included)
+        step_tokens = trn_input['attention_mask'].sum() + (trn_input['labels'] != -100).sum()
+        metric_logger.update(tok_s=step_tokens.item() / max(time.time() - step_start, 1e-6))
         metric_logger.update(closs=c_loss_value)
         if use_search and not retrain_mode:
             if data_iter_step % search_step == 0:
@@ -159,8 +165,15 @@ def evaluate(model, tokenizer, dataloader, compute_metrics, data_info, args=None
     outputs = []
     labels = []
 
+    candidates = None
+    if args is not None and args.label_scoring:
+        candidates = label_candidates(tokenizer, args.task_name)
+
     for inputs in tqdm(dataloader):
-        loss, generated_tokens, label = prediction_step(model.t5_model, tokenizer, inputs, args=args)
+        if candidates is not None:
+            loss, generated_tokens, label = scoring_step(model.t5_model, tokenizer, inputs, candidates, args=args)
+        else:
+            loss, generated_tokens, label = prediction_step(model.t5_model, tokenizer, inputs, args=args)
         loss_list.append(loss.item())
         outputs.append(generated_tokens.cpu())
         labels.append(label.cpu())
@@ -217,6 +230,66 @@ def prediction_step(
 
     return (loss, generated_tokens, labels)
 
+def label_candidates(tokenizer, task_name):
+    # tokenized label set of a classification task ([labels, len] ids and mask), None for free-form targets
+    labels_list = AutoTask.get(task_name, ["en"]).labels_list
+    if labels_list is None:
+        return None
+    tokens = tokenizer(list(labels_list), padding=True, return_tensors="pt")
+    return tokens["input_ids"], tokens["attention_mask"]
+
+
+def scoring_step(
+    model,
+    tokenizer,
+    inputs,
+    candidates,
+    args=None
+):
+    """
+    prediction_step for tasks with a fixed label set: one encoder pass, one teacher-forced decoder pass over
+    all (example, label) pairs, and the label of highest length-normalized log-likelihood is returned as the generated tokens.
+    """
+    for k, v in inputs.items():
+        inputs[k] = v.to(model.device)
+    candidate_ids, candidate_mask = candidates[0].to(model.device), candidates[1].to(model.device)
+    batch_size, num_labels = inputs["input_ids"].shape[0], candidate_ids.shape[0]
+    all_max_length = model.config.max_length
+
+    encoder_outputs = model.get_encoder()(
+        input_ids=inputs["input_ids"],
+        attention_mask=inputs["attention_mask"],
+        return_dict=True,
+    )
+    # [batch * labels, ...]: every example against every label
+    hidden_states = encoder_outputs[0].repeat_interleave(num_labels, dim=0)
+    decoder_labels = candidate_ids.repeat(batch_size, 1)
+    outputs = model(
+        encoder_outputs=(hidden_states,),
+        attention_mask=inputs["attention_mask"].repeat_interleave(num_labels, dim=0),
+        decoder_input_ids=model._shift_right(decoder_labels),
+        use_cache=False,
+        return_dict=True,
+    )
+    log_probs = outputs.logits.float().log_softmax(dim=-1)
+    token_log_probs = log_probs.gather(-1, decoder_labels.unsqueeze(-1)).squeeze(-1) * candidate_mask.repeat(batch_size, 1)
+    # mean per-token log-likelihood, so labels of different token lengths (e.g. stsb "0.2" vs "5.0") compete fairly
+    label_scores = token_log_probs.sum(-1) / candidate_mask.sum(-1).repeat(batch_size)
+    best = label_scores.view(batch_size, num_labels).argmax(dim=-1)
+
+    # same layout as generate: decoder start token, then the label
+    start = torch.full((batch_size, 1), model.config.decoder_start_token_id, dtype=candidate_ids.dtype, device=candidate_ids.device)
+    generated_tokens = torch.cat([start, candidate_ids[best]], dim=-1).cpu()
+    if generated_tokens.shape[-1] < all_max_length and not args.test_module:
+        generated_tokens = _pad_tensors_to_max_len(model, tokenizer, generated_tokens, all_max_length)
+
+    loss = torch.Tensor([0])
+    labels = inputs["labels"].cpu()
+    if labels.shape[-1] < all_max_length and not args.test_module:
+        labels = _pad_tensors_to_max_len(model, tokenizer, labels, all_max_length)
+
+    return (loss, generated_tokens, labels)
+
 def _pad_tensors_to_max_len(model, tokenizer, tensor, max_length):
     if tokenizer is not None and hasattr(tokenizer, "pad_token_id"):
         # If PAD token is not defined at least EOS token has to be defined
@@ -0,0 +1,211 @@
+import argparse
+import os
+
+import torch
+import torch.nn as nn
+
+from serve import load_finalized_model
+from space.static_model import build_static_model
+from train import get_args_parser
+
+
+DEFAULT_SAMPLES = [
+    "sst2 sentence: it 's a charming and often affecting journey .",
+    "rte sentence1: The cat sat on the mat. sentence2: A cat is sitting.",
+]
+
+
+def get_export_args_parser():
+    parser = argparse.ArgumentParser('BIPEFT export', parents=[get_args_parser()])
+    parser.add_argument('--arch_resume', default='', help='checkpoint holding the arch weights, defaults to --resume')
+    parser.add_argument('--export_dir', required=True, type=str)
+    parser.add_argument('--format', default='torchscript', type=str, choices=['torchscript', 'onnx', 'both'])
+    parser.add_argument('--no_merge', action='store_false', dest='merge',
+                        help='keep the selected LoRA/BitFit/LNfit as explicit ops instead of folding them into the weights')
+    parser.add_argument('--opset', default=14, type=int)
+    parser.add_argument('--max_source_length', default=512, type=int)
+    parser.add_argument('--check_max_length', default=32, type=int, help='greedy length of the parity check against generate')
+    parser.add_argument('--sample_text', action='append', default=None, help='parity check input, repeatable')
+    parser.add_argument('--skip_check', action='store_true')
+    return parser
+
+
+class EncoderExport(nn.Module):
+    # input_ids, attention_mask -> encoder_hidden_states
+    def __init__(self, t5_model):
+        super().__init__()
+        self.encoder = t5_model.encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class DecoderExport(nn.Module):
+    """
+    One decoding step with the cache flattened to tensors: (decoder_input_ids, encoder_hidden_states,
+    encoder_attention_mask, *past) -> (logits, *present), 4 tensors per layer (self k/v, cross k/v) as in
+    transformers. Without past it is the first step, which also projects the cross-attention k/v.
+    """
+    def __init__(self, t5_model):
+        super().__init__()
+        self.decoder = t5_model.decoder
+        self.lm_head = t5_model.lm_head
+        self.num_layers = len(t5_model.decoder.block)
+        # T5ForConditionalGeneration rescales before the tied lm_head
+        self.scale = t5_model.config.d_model ** -0.5 if t5_model.config.tie_word_embeddings else 1.0
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        past_key_values = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(self.num_layers)) if past else None
+        outputs = self.decoder(input_ids=decoder_input_ids, encoder_hidden_states=encoder_hidden_states,
+                               encoder_attention_mask=encoder_attention_mask, past_key_values=past_key_values,
+                               use_cache=True, return_dict=False)
+        logits = self.lm_head(outputs[0] * self.scale)
+        return (logits,) + tuple(states for layer in outputs[1] for states in layer)
+
+
+def past_names(num_layers, prefix):
+    return [f"{prefix}.{i}.{name}" for i in range(num_layers) for name in ["self_key", "self_value", "cross_key", "cross_value"]]
+
+
+def export_model(t5_model, example, export_dir, fmt='torchscript', opset=14):
+    """
+    Exports encoder, decoder_init (first step) and decoder (with past) of the static T5 to export_dir.
+    example: tokenized inputs used for tracing.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    encoder, decoder = EncoderExport(t5_model).eval(), DecoderExport(t5_model).eval()
+    input_ids, attention_mask = example["input_ids"], example["attention_mask"]
+    start = torch.full((input_ids.shape[0], 1), t5_model.config.decoder_start_token_id, dtype=torch.long)
+    encoder_hidden_states = encoder(input_ids, attention_mask)
+    init_outputs = decoder(start, encoder_hidden_states, attention_mask)
+    past = init_outputs[1:]
+    step_inputs = (start, encoder_hidden_states, attention_mask) + tuple(past)
+    graphs = {"encoder": (encoder, (input_ids, attention_mask)),
+              "decoder_init": (decoder, (start, encoder_hidden_states, attention_mask)),
+              "decoder": (decoder, step_inputs)}
+
+    paths = dict()
+    if fmt in ['torchscript', 'both']:
+        for name, (module, inputs) in graphs.items():
+            traced = torch.jit.trace(module, inputs, check_trace=False)
+            paths[name + ".pt"] = os.path.join(export_dir, name + ".pt")
+            traced.save(paths[name + ".pt"])
+    if fmt in ['onnx', 'both']:
+        num_layers = decoder.num_layers
+        batch_seq = {0: "batch", 1: "source_length"}
+        io_names = {
+            "encoder": (["input_ids", "attention_mask"], ["encoder_hidden_states"],
+                        {"input_ids": batch_seq, "attention_mask": batch_seq, "encoder_hidden_states": batch_seq}),
+            "decoder_init": (["decoder_input_ids", "encoder_hidden_states", "encoder_attention_mask"],
+                             ["logits"] + past_names(num_layers, "present"), None),
+            "decoder": (["decoder_input_ids", "encoder_hidden_states", "encoder_attention_mask"] + past_names(num_layers, "past"),
+                        ["logits"] + past_names(num_layers, "present"), None),
+        }
+        for name, (module, inputs) in graphs.items():
+            input_names, output_names, dynamic_axes = io_names[name]
+            if dynamic_axes is None:
+                dynamic_axes = {"decoder_input_ids": {0: "batch", 1: "target_length"}, "logits": {0: "batch", 1: "target_length"},
+                                "encoder_hidden_states": batch_seq, "encoder_attention_mask": batch_seq}
+                for n in input_names[3:] + output_names[1:]:
+                    # self-attention caches grow with the decoded length, cross-attention ones follow the source
+                    dynamic_axes[n] = {0: "batch", 2: "past_length" if "self" in n else "source_length"}
+            paths[name + ".onnx"] = os.path.join(export_dir, name + ".onnx")
+            torch.onnx.export(module, inputs, paths[name + ".onnx"], input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+    return paths
+
+
+def onnx_runner(path):
+    # an exported onnx graph as a torch-in, torch-out callable
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    names = [i.name for i in session.get_inputs()]
+
+    def run(*inputs):
+        outputs = session.run(None, {n: t.cpu().numpy() for n, t in zip(names, inputs)})
+        return tuple(torch.from_numpy(o) for o in outputs)
+    return run
+
+
+def greedy_generate(encoder, decoder_init, decoder, input_ids, attention_mask, config, max_length):
+    # greedy decoding on the exported graphs, with the stopping/padding of transformers' greedy_search
+    encoder_hidden_states = encoder(input_ids, attention_mask)
+    encoder_hidden_states = encoder_hidden_states[0] if isinstance(encoder_hidden_states, tuple) else encoder_hidden_states
+    tokens = torch.full((input_ids.shape[0], 1), config.decoder_start_token_id, dtype=torch.long)
+    finished = torch.zeros(input_ids.shape[0], dtype=torch.bool)
+    past = None
+    while tokens.shape[1] < max_length:
+        if past is None:
+            outputs = decoder_init(tokens, encoder_hidden_states, attention_mask)
+        else:
+            outputs = decoder(tokens[:, -1:], encoder_hidden_states, attention_mask, *past)
+        logits, past = outputs[0], outputs[1:]
+        next_tokens = logits[:, -1].argmax(-1).masked_fill(finished, config.pad_token_id)
+        tokens = torch.cat([tokens, next_tokens[:, None]], dim=1)
+        finished = finished | (next_tokens == config.eos_token_id)
+        if finished.all():
+            break
+    return tokens
+
+
+@torch.no_grad()
+def reference_generate(t5_model, inputs, max_length):
+    # greedy generate() of the finalized MoM_T5, taken before build_static_model merges and rewrites it
+    return t5_model.generate(inputs["input_ids"], attention_mask=inputs["attention_mask"], max_length=max_length,
+                             num_beams=1, do_sample=False)
+
+
+@torch.no_grad()
+def check_parity(config, reference, runners, inputs, max_length):
+    # the exported graphs must decode exactly what generate() of the finalized MoM_T5 does (reference)
+    results = dict()
+    for fmt, (encoder, decoder_init, decoder) in runners.items():
+        tokens = greedy_generate(encoder, decoder_init, decoder, inputs["input_ids"], inputs["attention_mask"],
+                                 config, max_length)
+        length = max(tokens.shape[1], reference.shape[1])
+        pad = config.pad_token_id
+        tokens = nn.functional.pad(tokens, (0, length - tokens.shape[1]), value=pad)
+        expected = nn.functional.pad(reference, (0, length - reference.shape[1]), value=pad)
+        results[fmt] = bool(torch.equal(tokens, expected))
+        print(f"{fmt}: {'matches' if results[fmt] else 'DIFFERS from'} generate() on {inputs['input_ids'].shape[0]} samples")
+    return results
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device("cpu")
+    # export traces the eager kernels; the dynamic int8 kernel has no onnx export, its int8 weights do
+    args.attn_backend = "eager"
+    if args.format != "torchscript" and args.int8_backbone == "dynamic":
+        args.int8_backbone = "weight"
+    args.static_model = False
+    arch, tokenizer = load_finalized_model(args, device)
+    samples = args.sample_text if args.sample_text else DEFAULT_SAMPLES
+    inputs = tokenizer(samples, max_length=args.max_source_length, truncation=True, padding=True, return_tensors="pt")
+    reference = None if args.skip_check else reference_generate(arch.t5_model, inputs, args.check_max_length)
+
+    model = build_static_model(arch, merge=args.merge)
+    model.eval()
+    t5_model = model.t5_model
+    paths = export_model(t5_model, inputs, args.export_dir, fmt=args.format, opset=args.opset)
+    for name, path in paths.items():
+        print(f"Exported {name} to {path}")
+    if args.skip_check:
+        return
+
+    runners = dict()
+    if args.format in ["torchscript", "both"]:
+        runners["torchscript"] = tuple(torch.jit.load(paths[name + ".pt"]) for name in ["encoder", "decoder_init", "decoder"])
+    if args.format in ["onnx", "both"]:
+        try:
+            runners["onnx"] = tuple(onnx_runner(paths[name + ".onnx"]) for name in ["encoder", "decoder_init", "decoder"])
+        except ImportError:
+            print("onnxruntime is not installed, skipping the onnx parity check")
+    results = check_parity(t5_model.config, reference, runners, inputs, args.check_max_length)
+    if not all(results.values()):
+        raise SystemExit("exported graphs do not match generate()")
+
+
+if __name__ == '__main__':
+    args = get_export_args_parser().parse_args()
+    main(args)
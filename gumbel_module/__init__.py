@@ -1,2 +1,2 @@
-from .beta_func_parallel import bernoulli_sample
+from .beta_func_parallel import bernoulli_sample, gumbel_sample_weight
 from .gumbelmodule import GumbleSoftmax
\ No newline at end of file
@@ -41,11 +41,11 @@ def gumbel_sample_weight(str_weights, temp=1., binary_mask=None, binary_prune_ma
         weight_all = F.gumbel_softmax(str_weights, tau=temp, hard=True)
     if binary_mask is not None or binary_prune_mask is not None:
         if binary_prune_mask is not None and binary_mask is not None:
-            binary_mask = binary_mask.cuda() | binary_prune_mask.cuda()
+            binary_mask = binary_mask.to(weight_all.device) | binary_prune_mask.to(weight_all.device)
         elif binary_prune_mask is not None:
             binary_mask = binary_prune_mask
         # print(binary_mask.size(),"nfviw", weight_all.size())
-        weight_all = weight_all * binary_mask.unsqueeze(-1).cuda()
+        weight_all = weight_all * binary_mask.unsqueeze(-1).to(weight_all.device)
     return weight_all
 
 
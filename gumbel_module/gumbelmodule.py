@@ -22,15 +22,14 @@ class GumbleSoftmax(torch.nn.Module):
     def cpu(self):
         self.gpu = False
 
-    def sample_gumbel(self, shape, eps=1e-10):
-        """Sample from Gumbel(0, 1)"""
-        noise = torch.rand(shape)
+    def sample_gumbel(self, shape, eps=1e-10, device=None):
+        """Sample from Gumbel(0, 1) on `device` (the current cuda device after .cuda() when not given)"""
+        if device is None and self.gpu:
+            device = torch.cuda.current_device()
+        noise = torch.rand(shape, device=device)
         noise.add_(eps).log_().neg_()
         noise.add_(eps).log_().neg_()
-        if self.gpu:
-            return Variable(noise).cuda()
-        else:
-            return Variable(noise)
+        return Variable(noise)
 
     def sample_gumbel_like(self, template_tensor, eps=1e-10):
         uniform_samples_tensor = template_tensor.clone().uniform_()
@@ -0,0 +1,167 @@
+import argparse
+import itertools
+import json
+import queue
+import threading
+import time
+
+import torch
+
+from examples_seq2seq.data_processors import AutoTask
+from serve import load_finalized_model
+from train import get_args_parser
+
+
+def get_predict_args_parser():
+    parser = argparse.ArgumentParser('BIPEFT offline batch prediction', parents=[get_args_parser()])
+    parser.add_argument('--arch_resume', default='', help='checkpoint holding the arch weights, defaults to --resume')
+    parser.add_argument('--input_file', required=True, type=str, help='jsonl, one raw example of --task_name per line')
+    parser.add_argument('--output_file', required=True, type=str)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--sort_window', default=2048, type=int, help='rows sorted by length together, bounds the memory')
+    parser.add_argument('--max_source_length', default=512, type=int)
+    parser.add_argument('--gen_max_length', default=None, type=int, help='generation length, defaults to the model config')
+    parser.add_argument('--num_beams', default=None, type=int, help='beam size, defaults to the model config')
+    parser.add_argument('--no_task_prefix', action='store_false', dest='add_prefix')
+    return parser
+
+
+def read_rows(path):
+    with open(path, encoding="utf-8") as f:
+        for idx, line in enumerate(f):
+            if line.strip():
+                yield idx, json.loads(line)
+
+
+def source_batches(rows, task, tokenizer, batch_size, sort_window, max_source_length, add_prefix=True):
+    """
+    rows -> (rows, sources, padded inputs) batches; within each window of sort_window rows the batches are
+    taken in length order so that little padding is generated.
+    """
+    rows = iter(rows)
+    while True:
+        window = list(itertools.islice(rows, sort_window))
+        if not window:
+            return
+        items = []
+        for idx, example in window:
+            # unlabeled rows: the target is not used for prediction
+            example.setdefault("label", -1)
+            source = task.preprocessor(example, add_prefix=add_prefix)["source"]
+            items.append((idx, source, tokenizer(source, max_length=max_source_length, truncation=True)["input_ids"]))
+        items.sort(key=lambda item: len(item[2]))
+        for i in range(0, len(items), batch_size):
+            chunk = items[i:i + batch_size]
+            inputs = tokenizer.pad({"input_ids": [item[2] for item in chunk]}, return_tensors="pt")
+            yield [item[0] for item in chunk], [item[1] for item in chunk], inputs
+
+
+def threaded(generator, max_prefetch=4):
+    # run a generator in its own thread, items handed over through a bounded queue
+    items = queue.Queue(max_prefetch)
+    end = object()
+
+    def produce():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class PredictionWriter(object):
+    # decodes and writes on its own thread, so the model never waits for the output file. an error on that
+    # thread stops it and is raised by the next put() or close() instead of leaving them blocked on the queue
+    def __init__(self, path, tokenizer, max_pending=4):
+        self.file = open(path, "w", encoding="utf-8")
+        self.tokenizer = tokenizer
+        self.pending = queue.Queue(max_pending)
+        self.rows = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def put(self, indices, sources, generated_tokens):
+        self.hand_over((indices, sources, generated_tokens))
+
+    def hand_over(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def loop(self):
+        try:
+            while True:
+                item = self.pending.get()
+                if item is None:
+                    break
+                indices, sources, generated_tokens = item
+                predictions = self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+                for idx, source, prediction in zip(indices, sources, predictions):
+                    self.file.write(json.dumps({"idx": idx, "source": source, "prediction": prediction.strip()}) + "\n")
+                self.file.flush()
+                self.rows += len(indices)
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        try:
+            self.hand_over(None)
+            self.thread.join()
+        finally:
+            self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    model, tokenizer = load_finalized_model(args, device)
+    t5_model = model.t5_model
+    gen_kwargs = {
+        "max_length": args.gen_max_length if args.gen_max_length is not None else t5_model.config.max_length,
+        "num_beams": args.num_beams if args.num_beams is not None else t5_model.config.num_beams,
+    }
+    task = AutoTask.get(args.task_name, ["en"], seed=args.seed)
+
+    batches = threaded(source_batches(read_rows(args.input_file), task, tokenizer, args.batch_size, args.sort_window,
+                                      args.max_source_length, add_prefix=args.add_prefix))
+    writer = PredictionWriter(args.output_file, tokenizer)
+    start_time = time.time()
+    try:
+        for i, (indices, sources, inputs) in enumerate(batches):
+            generated_tokens = t5_model.generate(
+                inputs["input_ids"].to(device),
+                attention_mask=inputs["attention_mask"].to(device),
+                **gen_kwargs,
+            ).cpu()
+            writer.put(indices, sources, generated_tokens)
+            if i % 50 == 0:
+                print(f"{writer.rows} rows, {writer.rows / max(time.time() - start_time, 1e-6):.1f} rows/s")
+    finally:
+        writer.close()
+    total_time = time.time() - start_time
+    print(f"Predicted {writer.rows} rows in {total_time:.1f}s ({writer.rows / max(total_time, 1e-6):.1f} rows/s)")
+
+
+if __name__ == '__main__':
+    args = get_predict_args_parser().parse_args()
+    main(args)
@@ -0,0 +1,317 @@
+import argparse
+import copy
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from transformers import AutoTokenizer
+from transformers.models.t5.modeling_t5 import T5Config, T5ForConditionalGeneration
+
+from space.t5_search_space import MoM_T5
+from space.static_model import build_static_model
+from space.adapter_bank import AdapterBank
+from space.peft_layers import quantize_linears
+from train import get_args_parser
+
+
+def get_serve_args_parser():
+    parser = argparse.ArgumentParser('BIPEFT inference server', parents=[get_args_parser()])
+    parser.add_argument('--arch_resume', default='', help='checkpoint holding the arch weights, defaults to --resume')
+    parser.add_argument('--bank_config', default='', type=str,
+                        help='json {task: {"resume": ..., "arch_resume": ..., "args": {...}}}: serve all tasks on one backbone')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default='', type=str, help='serve on this unix socket instead of host:port')
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--max_batch_tokens', default=8192, type=int, help='budget of padded source tokens per micro-batch')
+    parser.add_argument('--max_wait_ms', default=5.0, type=float, help='how long the first request of a micro-batch waits for others')
+    parser.add_argument('--max_source_length', default=512, type=int)
+    parser.add_argument('--gen_max_length', default=None, type=int, help='generation length, defaults to the model config')
+    parser.add_argument('--num_beams', default=None, type=int, help='beam size, defaults to the model config')
+    return parser
+
+
+def load_finalized_model(args, device):
+    """
+    Rebuild the searched model from its checkpoints: the arch weights select and slice the PEFT modules
+    (finalize_arch), then the retrained PEFT weights are loaded into the finalized shapes.
+    Works for checkpoints saved from MoM_T5 and from the static model, which share parameter names; a checkpoint
+    missing any arch or trainable PEFT weight of the model, or holding keys the model does not have, is rejected.
+    """
+    config = T5Config.from_pretrained(args.model_name_or_path)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    backbone = T5ForConditionalGeneration.from_pretrained(args.model_name_or_path)
+    backbone.resize_token_embeddings(len(tokenizer))
+
+    args.retrain = True
+    model = MoM_T5(backbone, r=args.lora_rank, model_config=config, args=args)
+    state = torch.load(args.resume, map_location='cpu')['model']
+    arch_state = torch.load(args.arch_resume, map_location='cpu')['model'] if args.arch_resume else state
+    arch_keys = {k for k in model.state_dict() if 'arch' in k}
+    missing = sorted(arch_keys - arch_state.keys())
+    if missing:
+        raise ValueError(f"{args.arch_resume or args.resume} has no arch weights for {missing}, "
+                         f"pass the search checkpoint with --arch_resume")
+    model.load_state_dict({k: v for k, v in arch_state.items() if k in arch_keys}, strict=False)
+    model.finalize_arch()
+    # a checkpoint of the full precision backbone keeps the quantized (frozen, pretrained) weights
+    int8_keys = {k for k, v in model.state_dict().items() if v.dtype == torch.int8}
+    result = model.load_state_dict({k: v for k, v in state.items() if k not in int8_keys or v.dtype == torch.int8}, strict=False)
+    peft_keys = {n for n, p in model.named_parameters() if p.requires_grad and 'arch' not in n}
+    missing = sorted(peft_keys & set(result.missing_keys))
+    if missing or result.unexpected_keys:
+        raise ValueError(f"{args.resume} does not match the finalized architecture: "
+                         f"missing {missing}, unexpected {sorted(result.unexpected_keys)}")
+    if args.static_model:
+        model = build_static_model(model)
+    model.to(device)
+    model.eval()
+    return model, tokenizer
+
+
+def load_adapter_bank(args, device):
+    # every task is finalized on a temporary backbone on cpu, only its PEFT entries stay in the bank
+    with open(args.bank_config) as f:
+        bank_config = json.load(f)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    backbone = T5ForConditionalGeneration.from_pretrained(args.model_name_or_path)
+    backbone.resize_token_embeddings(len(tokenizer))
+    if args.int8_backbone != 'none':
+        quantize_linears(backbone.encoder, mode=args.int8_backbone)
+        quantize_linears(backbone.decoder, mode=args.int8_backbone)
+    bank = AdapterBank(backbone)
+    for task, entry in bank_config.items():
+        task_args = copy.copy(args)
+        task_args.resume, task_args.arch_resume = entry['resume'], entry.get('arch_resume', '')
+        task_args.static_model = False
+        for k, v in entry.get('args', dict()).items():
+            setattr(task_args, k, v)
+        arch, _ = load_finalized_model(task_args, torch.device('cpu'))
+        bank.add_task(task, arch)
+        del arch
+        print(f"Added {task} to the adapter bank")
+    bank.pack()
+    bank.to(device)
+    bank.eval()
+    return bank, tokenizer
+
+
+class InferenceRequest(object):
+    def __init__(self, text, input_ids, task=None):
+        self.text = text
+        self.task = task
+        self.input_ids = input_ids
+        self.output = None
+        self.error = None
+        self.enqueue_time = time.perf_counter()
+        self.start_time, self.finish_time = None, None
+        self.done = threading.Event()
+
+    @property
+    def queue_ms(self):
+        return (self.start_time - self.enqueue_time) * 1000
+
+    @property
+    def latency_ms(self):
+        return (self.finish_time - self.enqueue_time) * 1000
+
+
+class MicroBatcher(object):
+    """
+    Requests from all connections go through one queue; a worker thread takes the oldest request, waits at
+    most max_wait_ms for more, and runs them as one padded batch while it stays within max_batch_size and
+    max_batch_tokens (longest source * batch size).
+    """
+    def __init__(self, model, tokenizer, device, max_batch_size=32, max_batch_tokens=8192, max_wait_ms=5.0,
+                 max_source_length=512, gen_kwargs=None):
+        self.model = model
+        self.t5_model = model.t5_model
+        self.bank = isinstance(model, AdapterBank)
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.max_source_length = max_source_length
+        self.gen_kwargs = gen_kwargs if gen_kwargs is not None else dict()
+        self.requests = queue.Queue()
+        self.pending = None  # request that did not fit in the previous batch
+        self.stats = {"requests": 0, "batches": 0, "queue_ms": 0.0, "latency_ms": 0.0}
+        self.stats_lock = threading.Lock()
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, text, task=None):
+        input_ids = self.tokenizer(text, max_length=self.max_source_length, truncation=True)["input_ids"]
+        request = InferenceRequest(text, input_ids, task=task)
+        self.requests.put(request)
+        return request
+
+    def next_batch(self):
+        first = self.pending if self.pending is not None else self.requests.get()
+        self.pending = None
+        batch, longest = [first], len(first.input_ids)
+        deadline = first.enqueue_time + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if max(longest, len(request.input_ids)) * (len(batch) + 1) > self.max_batch_tokens:
+                self.pending = request
+                break
+            batch.append(request)
+            longest = max(longest, len(request.input_ids))
+        return batch
+
+    @torch.no_grad()
+    def run(self, batch):
+        inputs = self.tokenizer.pad({"input_ids": [request.input_ids for request in batch]}, return_tensors="pt")
+        if self.bank:
+            # rows of different tasks share the batch
+            self.model.route([request.task for request in batch])
+        generated_tokens = self.t5_model.generate(
+            inputs["input_ids"].to(self.device),
+            attention_mask=inputs["attention_mask"].to(self.device),
+            **self.gen_kwargs,
+        )
+        return self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            start_time = time.perf_counter()
+            for request in batch:
+                request.start_time = start_time
+            try:
+                outputs = self.run(batch)
+            except Exception as e:
+                outputs = [None] * len(batch)
+                for request in batch:
+                    request.error = repr(e)
+            finish_time = time.perf_counter()
+            with self.stats_lock:
+                self.stats["batches"] += 1
+                for request, output in zip(batch, outputs):
+                    request.output = output.strip() if output is not None else None
+                    request.finish_time = finish_time
+                    self.stats["requests"] += 1
+                    self.stats["queue_ms"] += request.queue_ms
+                    self.stats["latency_ms"] += request.latency_ms
+            for request in batch:
+                request.done.set()
+
+    def summary(self):
+        with self.stats_lock:
+            n, batches = max(self.stats["requests"], 1), max(self.stats["batches"], 1)
+            return {"requests": self.stats["requests"], "batches": self.stats["batches"],
+                    "mean_batch_size": self.stats["requests"] / batches,
+                    "mean_queue_ms": self.stats["queue_ms"] / n, "mean_latency_ms": self.stats["latency_ms"] / n,
+                    "queued": self.requests.qsize()}
+
+
+def make_handler(batcher):
+    class InferenceHandler(BaseHTTPRequestHandler):
+        # POST /generate {"inputs": str or [str], "task": name (adapter bank)} -> {"outputs", "latency_ms", "queue_ms"}; GET /stats
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self.send_json(404, {"error": "unknown path"})
+            self.send_json(200, batcher.summary())
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self.send_json(404, {"error": "unknown path"})
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                inputs = payload["inputs"]
+            except (ValueError, KeyError, TypeError):
+                return self.send_json(400, {"error": 'expected a json body {"inputs": str or [str]}'})
+            task = payload.get("task")
+            if batcher.bank and task not in batcher.model.tasks:
+                return self.send_json(400, {"error": f"unknown task {task}, the bank serves {list(batcher.model.tasks)}"})
+            single = isinstance(inputs, str)
+            requests = [batcher.submit(text, task=task) for text in ([inputs] if single else inputs)]
+            for request in requests:
+                request.done.wait()
+            errors = [request.error for request in requests if request.error is not None]
+            if errors:
+                return self.send_json(500, {"error": errors[0]})
+            result = {"outputs": [request.output for request in requests],
+                      "latency_ms": [request.latency_ms for request in requests],
+                      "queue_ms": [request.queue_ms for request in requests]}
+            if single:
+                result = {k: v[0] for k, v in result.items()}
+            self.send_json(200, result)
+
+        def address_string(self):
+            # unix socket clients have no address
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def main(args):
+    device = torch.device(args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if args.bank_config:
+        model, tokenizer = load_adapter_bank(args, device)
+    else:
+        model, tokenizer = load_finalized_model(args, device)
+
+    gen_kwargs = {
+        "max_length": args.gen_max_length if args.gen_max_length is not None else model.t5_model.config.max_length,
+        "num_beams": args.num_beams if args.num_beams is not None else model.t5_model.config.num_beams,
+    }
+    batcher = MicroBatcher(model, tokenizer, device, max_batch_size=args.max_batch_size,
+                           max_batch_tokens=args.max_batch_tokens, max_wait_ms=args.max_wait_ms,
+                           max_source_length=args.max_source_length, gen_kwargs=gen_kwargs)
+    batcher.start()
+
+    handler = make_handler(batcher)
+    if args.unix_socket:
+        server = ThreadingUnixHTTPServer(args.unix_socket, handler)
+        print(f"Serving on unix socket {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served: {batcher.summary()}")
+
+
+if __name__ == '__main__':
+    args = get_serve_args_parser().parse_args()
+    main(args)
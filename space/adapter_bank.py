@@ -0,0 +1,237 @@
+import torch
+import torch.nn as nn
+
+from space.peft_layers import t5_rms_normalize
+from space.peft_modules import Mix_PEFT
+from space.static_model import branch_kept
+from space.forward_injection import reset_forward
+from space.t5_forward_mom import static_attn_forward
+
+
+def lora_factors(lora):
+    # (A [rank, in], B [out, rank]) of a finalized LoRA branch as its non-search forward uses them
+    w_a, w_b = lora.LoRA_a.weight, lora.LoRA_b.weight
+    if lora.fix_weight is not None:
+        w_a, w_b = w_a[:lora.dim_choice, :], w_b[:, :lora.dim_choice]
+    return w_a, w_b
+
+
+class BankRoute(object):
+    """
+    Task id of every row of the current batch, shared by all bank modules. Generation repeats the rows
+    (beams), so the ids are repeated to the batch size a module sees.
+    """
+    def __init__(self):
+        self.task_ids = None
+        self.views = dict()
+
+    def set(self, task_ids):
+        self.task_ids = task_ids
+        self.views = dict()
+
+    def rows(self, batch_size):
+        # (task ids [batch_size], [(task, row indices)]) for a batch of batch_size rows
+        if batch_size not in self.views:
+            task_ids = self.task_ids
+            if task_ids.shape[0] != batch_size:
+                task_ids = task_ids.repeat_interleave(batch_size // task_ids.shape[0])
+            groups = [(t, (task_ids == t).nonzero(as_tuple=True)[0]) for t in task_ids.unique().tolist()]
+            self.views[batch_size] = (task_ids, groups)
+        return self.views[batch_size]
+
+
+class TaskEntry(nn.Module):
+    # the sequential branches (adapter, SA, PA) of one task at one position, the rest is stacked in BankPEFT
+    def __init__(self, adapter=None, sadapter=None, padapter=None):
+        super().__init__()
+        self.adapter, self.sadapter, self.padapter = adapter, sadapter, padapter
+
+    def forward(self, x, hiddens):
+        # hidden delta of the sequential branches, as Mix_PEFT composes them
+        hidden_flow = hiddens
+        if self.adapter is not None:
+            hidden_flow = hidden_flow + self.adapter(hidden_flow)
+        if self.sadapter is not None:
+            hidden_flow = hidden_flow + self.sadapter(hidden_flow)
+        if self.padapter is not None:
+            hidden_flow = hidden_flow + self.padapter(x)
+        return hidden_flow - hiddens
+
+
+class BankPEFT(nn.Module):
+    """
+    One wrapped position of the shared backbone with the finalized branches of every task. LoRA factors
+    (zero-padded to the largest rank), BitFit biases and LNfit weights are stacked over tasks and gathered per
+    row, so a batch mixing tasks runs in one pass; adapters/SA/PA run per task on their rows.
+    """
+    def __init__(self, original_module, route):
+        super().__init__()
+        self.original_module = original_module
+        self.route = route
+        self.entries = nn.ModuleDict()
+        self.task_branches = dict()
+        for name in ['lora_a', 'lora_b', 'bias', 'lnfit']:
+            self.register_buffer(name, None, persistent=False)
+
+    @property
+    def weight(self):
+        return self.original_module.weight
+
+    def add_task(self, task_id, shell):
+        branches = {name: module if branch_kept(module) else None for name, module in
+                    zip(['lora', 'bitfit', 'lnfit', 'adapter', 'sa', 'pa'],
+                        [shell.lora, shell.bitfit, shell.lnfit, shell.adapter, shell.sadapter, shell.padapter])}
+        self.task_branches[task_id] = branches
+        if any(branches[name] is not None for name in ['adapter', 'sa', 'pa']):
+            self.entries[str(task_id)] = TaskEntry(branches['adapter'], branches['sa'], branches['pa'])
+
+    @torch.no_grad()
+    def pack(self, num_tasks):
+        def stacked(values, shape):
+            # [tasks, *shape], zero-padded, zeros for tasks without the branch
+            ref = next(v for v in values if v is not None)
+            out = ref.new_zeros((num_tasks,) + tuple(shape))
+            for t, v in enumerate(values):
+                if v is not None:
+                    out[t][tuple(slice(0, n) for n in v.shape)] = v
+            return out
+
+        branches = [self.task_branches.get(t, dict()) for t in range(num_tasks)]
+        factors = [lora_factors(b['lora']) if b.get('lora') is not None else None for b in branches]
+        if any(f is not None and f[0].shape[0] > 0 for f in factors):
+            rank = max(f[0].shape[0] for f in factors if f is not None)
+            w_a, w_b = next(f for f in factors if f is not None)
+            self.lora_a = stacked([f[0] if f is not None else None for f in factors], (rank, w_a.shape[1]))
+            self.lora_b = stacked([f[1] if f is not None else None for f in factors], (w_b.shape[0], rank))
+        biases = [b['bitfit'].merged_bias() if b.get('bitfit') is not None else None for b in branches]
+        if any(v is not None for v in biases):
+            self.bias = stacked(biases, next(v for v in biases if v is not None).shape)
+        lnfit_weights = [b['lnfit'].scaled_weight() if b.get('lnfit') is not None else None for b in branches]
+        if any(v is not None for v in lnfit_weights):
+            self.lnfit = stacked(lnfit_weights, next(v for v in lnfit_weights if v is not None).shape)
+        self.task_branches = dict()
+
+    def forward(self, x, *args, **kwargs):
+        hidden_flow = self.original_module(x, *args, **kwargs)
+        hiddens = hidden_flow[0] if isinstance(hidden_flow, tuple) else hidden_flow
+        task_ids, groups = self.route.rows(x.shape[0])
+        row_shape = (x.shape[0],) + (1,) * (x.dim() - 2) + (-1,)
+
+        if self.lora_a is not None:
+            h = torch.einsum('b...i,bri->b...r', x, self.lora_a[task_ids].to(x.dtype))
+            hiddens = hiddens + torch.einsum('b...r,bor->b...o', h, self.lora_b[task_ids].to(x.dtype))
+        if self.lnfit is not None:
+            # LNfit only wraps T5 layer norms
+            hiddens = hiddens + self.lnfit[task_ids].view(row_shape) * \
+                      t5_rms_normalize(x, self.original_module.variance_epsilon, hiddens.dtype)
+        if self.bias is not None:
+            hiddens = hiddens + self.bias[task_ids].view(row_shape).to(hiddens.dtype)
+        if len(self.entries) > 0:
+            delta = None
+            for t, rows in groups:
+                if str(t) not in self.entries:
+                    continue
+                out = self.entries[str(t)](x.index_select(0, rows), hiddens.index_select(0, rows))
+                delta = (torch.zeros_like(hiddens) if delta is None else delta).index_add(0, rows, out)
+            if delta is not None:
+                hiddens = hiddens + delta
+
+        if isinstance(hidden_flow, tuple):
+            return (hiddens,) + hidden_flow[1:]
+        return hiddens
+
+
+class AdapterBank(nn.Module):
+    """
+    Finalized PEFT of many tasks on one frozen T5. add_task() takes a finalized MoM_T5 (its own backbone
+    copy can be dropped afterwards), pack() stacks the entries; then set the row tasks with route() and call
+    t5_model / generate as usual.
+    """
+    def __init__(self, t5_model):
+        super().__init__()
+        self.t5_model = t5_model
+        for param in t5_model.parameters():
+            param.requires_grad = False
+        self.bank_route = BankRoute()
+        self.tasks = dict()
+        self.bank_modules = dict()
+        self.prefixes, self.prefix_gates = dict(), dict()
+        self.early_stop = False
+
+    def bank_module(self, path):
+        if path not in self.bank_modules:
+            parent_name, _, attr = path.rpartition('.')
+            parent = self.t5_model
+            for part in parent_name.split('.') if parent_name else []:
+                # a position wrapped for an earlier task, step into it
+                parent = getattr(parent, part)
+                parent = parent.original_module if isinstance(parent, BankPEFT) else parent
+            module = BankPEFT(getattr(parent, attr), self.bank_route)
+            setattr(parent, attr, module)
+            self.bank_modules[path] = module
+        return self.bank_modules[path]
+
+    @torch.no_grad()
+    def add_task(self, name, arch):
+        task_id = self.tasks.setdefault(name, len(self.tasks))
+        shells = [(n.replace('.original_module', ''), m) for n, m in arch.t5_model.named_modules() if isinstance(m, Mix_PEFT)]
+        # inner positions first, their parents are still plain modules
+        for path, shell in sorted(shells, key=lambda item: -item[0].count('.')):
+            self.bank_module(path).add_task(task_id, shell)
+
+        prefix_module = getattr(arch.t5_model, 'prefix_module', None)
+        if prefix_module is not None:
+            prefix_module.iterative_order, prefix_module.main_forward = None, True
+            self.prefixes[task_id] = prefix_module.masked_key_values().detach()  # [layers, 2, prefix, dim]
+            attns = [blk.layer[0].SelfAttention for blk in list(arch.t5_model.encoder.block) + list(arch.t5_model.decoder.block)]
+            attns = [attn.original_module if hasattr(attn, 'original_module') else attn for attn in attns]
+            self.prefix_gates[task_id] = torch.cat([attn.prefix_gate.detach().view(1) for attn in attns])
+        return task_id
+
+    @torch.no_grad()
+    def pack(self):
+        num_tasks = len(self.tasks)
+        for module in self.bank_modules.values():
+            module.pack(num_tasks)
+        reset_forward(self.t5_model)
+        if self.prefixes:
+            shapes = {prefix.shape for prefix in self.prefixes.values()}
+            if len(shapes) > 1:
+                raise ValueError(f"tasks in one bank need the same prefix shape, got {shapes}")
+            shape = shapes.pop()
+            ref = next(iter(self.prefixes.values()))
+            # tasks without a prefix get zeros behind a zero gate
+            prefix_bank = ref.new_zeros((num_tasks,) + shape)
+            gate_bank = ref.new_zeros(num_tasks, shape[0])
+            for t, prefix in self.prefixes.items():
+                prefix_bank[t], gate_bank[t] = prefix, self.prefix_gates[t]
+            self.register_buffer('prefix_bank', prefix_bank, persistent=False)
+            self.register_buffer('gate_bank', gate_bank, persistent=False)
+            self.prefixes, self.prefix_gates = dict(), dict()
+            self.self_attns = [blk.layer[0].SelfAttention for blk in list(self.t5_model.encoder.block) + list(self.t5_model.decoder.block)]
+            self.self_attns = [attn.original_module if isinstance(attn, BankPEFT) else attn for attn in self.self_attns]
+            for attn in self.self_attns:
+                attn.forward = static_attn_forward.__get__(attn, attn.__class__)
+            self.num_encoder_layers = len(self.t5_model.encoder.block)
+            self.t5_model.encoder.register_forward_pre_hook(self.set_prefix, with_kwargs=True)
+            self.t5_model.decoder.register_forward_pre_hook(self.set_prefix, with_kwargs=True)
+
+    def set_prefix(self, stack, args, kwargs):
+        inputs = kwargs.get('input_ids') if kwargs.get('input_ids') is not None else kwargs.get('inputs_embeds')
+        if inputs is None:
+            inputs = args[0]
+        task_ids, _ = self.bank_route.rows(inputs.shape[0])
+        start = 0 if stack is self.t5_model.encoder else self.num_encoder_layers
+        for i in range(len(stack.block)):
+            attn = self.self_attns[start + i]
+            attn.static_prefix = self.prefix_bank[task_ids, start + i]  # [batch, 2, prefix, dim]
+            attn.prefix_gate = self.gate_bank[task_ids, start + i].view(-1, 1, 1, 1)
+
+    def route(self, tasks):
+        # tasks: one task name per row
+        ids = torch.tensor([self.tasks[task] for task in tasks], device=self.t5_model.device)
+        self.bank_route.set(ids)
+
+    def forward(self, x, tasks, cur_epoch=None, eval_mode=False, main_forward=False):
+        self.route(tasks)
+        return self.t5_model(**x)
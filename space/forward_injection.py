@@ -53,3 +53,57 @@ def set_lora_forward(model):
     print("Set new forward functions in T5 with lora weight as input!")
 
 
+def reset_forward(model):
+    # drop the forwards installed by set_lora_forward (or bound later), the modules fall back to the transformers ones
+    for module in model.modules():
+        if 'forward' in module.__dict__:
+            del module.forward
+
+
+def compile_blocks(model, dynamic=True, variants_per_block=8):
+    # torch.compile every T5 block forward (patched or not); stack/t5 forwards stay eager, so the python-side
+    # flags and gumbel dicts are fixed per block call and only guard the compiled graphs.
+    # all blocks share one code object and dynamo guards each on id(self): the cache limits must hold every
+    # block times its flag variants (iterative_order x main_forward, eval), or the extra blocks silently run eager
+    import torch._dynamo
+    blocks = list(model.encoder.block) + list(model.decoder.block)
+    config = torch._dynamo.config
+    config.cache_size_limit = max(config.cache_size_limit, variants_per_block)
+    if hasattr(config, 'accumulated_cache_size_limit'):
+        config.accumulated_cache_size_limit = max(config.accumulated_cache_size_limit, len(blocks) * variants_per_block)
+    else:
+        config.cache_size_limit = max(config.cache_size_limit, len(blocks) * variants_per_block)
+    for blk in blocks:
+        blk.forward = torch.compile(blk.forward, dynamic=dynamic)
+
+
+def graph_break_report(model, inputs, cur_epoch=0):
+    """
+    Graphs and graph breaks torch.compile finds in one training forward of model (MoM_T5 or StaticT5) on inputs:
+    the whole step traced as one region, and the breaks inside the compiled blocks when compile_blocks is on.
+    """
+    import torch._dynamo
+    from torch._dynamo.utils import counters
+
+    explanation = torch._dynamo.explain(lambda x: model(x=x, cur_epoch=cur_epoch, main_forward=True))(inputs)
+    print(f"whole step: {explanation.graph_count} graphs, {explanation.graph_break_count} graph breaks")
+    reasons = dict()
+    for reason in explanation.break_reasons:
+        reasons[reason.reason] = reasons.get(reason.reason, 0) + 1
+    for reason, n in sorted(reasons.items(), key=lambda item: -item[1]):
+        print(f"  {n}x {reason}")
+
+    counters.clear()
+    torch._dynamo.reset()
+    model(x=inputs, cur_epoch=cur_epoch, main_forward=True)
+    block_breaks = sum(counters["graph_break"].values())
+    # a block past the cache limit falls back to eager without a graph break, count those and the recompiles too
+    num_blocks = len(model.t5_model.encoder.block) + len(model.t5_model.decoder.block)
+    compiled_frames = counters["frames"]["ok"]
+    fallbacks = sum(n for reason, n in counters["unimplemented"].items() if "cache_size_limit" in reason)
+    # one frame per block plus one resume frame per graph break, anything beyond that was recompiled
+    recompiles = max(compiled_frames - num_blocks - block_breaks, 0)
+    print(f"compiled blocks: {block_breaks} graph breaks, {compiled_frames} frames compiled for {num_blocks} blocks, "
+          f"{recompiles} recompiles, {fallbacks} cache-limit fallbacks to eager")
+    return {"graph_count": explanation.graph_count, "graph_break_count": explanation.graph_break_count,
+            "block_graph_breaks": block_breaks, "block_recompiles": recompiles, "cache_limit_fallbacks": fallbacks}
@@ -1,8 +1,10 @@
 import torch
 import math
+from functools import partial
 import torch.nn as nn
 import numpy as np
 # import torch.nn.functional as F
+from torch.cuda.amp import custom_fwd, custom_bwd
 
 from transformers.activations import get_activation
 
@@ -12,6 +14,253 @@ def glorot_normal(tensor: torch.Tensor):
 def glorot_uniform(tensor: torch.Tensor):
     return torch.nn.init.xavier_uniform_(tensor, gain=math.sqrt(2))
 
+
+def get_search_dims(candidate_dims, candidate_dims_binary, iterative_order=None, main_forward=None, given_max_rank_id=None):
+    # binary stage: [0, searched dim], dimension stage: all candidate dims
+    if iterative_order is not None and (iterative_order or main_forward):
+        search_dims = candidate_dims_binary
+        if given_max_rank_id is not None:
+            search_dims[1] = candidate_dims[given_max_rank_id]
+    else:
+        search_dims = candidate_dims
+    return search_dims
+
+
+_rank_index_cache = {}
+
+
+def _rank_index(sample_dims, rank, device):
+    key = (tuple(int(d) for d in sample_dims), rank, device)
+    if key not in _rank_index_cache:
+        _rank_index_cache[key] = torch.tensor([min(d, rank) for d in key[0]], dtype=torch.long, device=device)
+    return _rank_index_cache[key]
+
+
+def nested_rank_scale(gumbel_weights, sample_dims, rank):
+    """
+    Collapse the gumbel weights over nested candidate ranks into one per-rank scale.
+    Entry i is the total weight of the candidates keeping rank i, i.e. sum_k g_k * [i < d_k],
+    computed as a reversed cumulative sum of the weights scattered at each candidate rank.
+    gumbel_weights: [..., K] -> [..., rank]
+    """
+    index = _rank_index(sample_dims, rank, gumbel_weights.device)
+    return _scale_from_index(gumbel_weights, index, rank)
+
+
+def _scale_from_index(gumbel_weights, index, rank):
+    prefix_weights = gumbel_weights.new_zeros(gumbel_weights.shape[:-1] + (rank + 1,))
+    prefix_weights = prefix_weights.index_add(prefix_weights.dim() - 1, index, gumbel_weights)
+    return prefix_weights.flip(-1).cumsum(-1).flip(-1)[..., 1:]
+
+def t5_rms_normalize(hidden_states, eps, dtype):
+    # T5LayerNorm without the weight: variance in fp32, back to half precision if the weight is
+    variance = hidden_states.to(torch.float32).pow(2).mean(-1, keepdim=True)
+    hidden_states = hidden_states * torch.rsqrt(variance + eps)
+    if dtype in [torch.float16, torch.bfloat16]:
+        hidden_states = hidden_states.to(dtype)
+    return hidden_states
+
+def prefix_keep_weight(gumbel_weights, candidate_dims, prefix_length, binary_stage, dimension_mask=None):
+    """
+    Per-layer, per-position weight of the prefix: [layers, K] gumbel weights -> [layers, prefix_length].
+    Binary stage keeps the (dimension-masked) prefix with weight g[:, 1]; dimension stage mixes the nested
+    prefix lengths. dimension_mask holds the kept prefix length of each layer.
+    """
+    if binary_stage:
+        keep = gumbel_weights[:, 1:2].expand(-1, prefix_length)
+    else:
+        keep = nested_rank_scale(gumbel_weights, candidate_dims, prefix_length)
+    if dimension_mask is not None:
+        positions = torch.arange(prefix_length, device=keep.device)
+        keep = keep * (positions[None, :] < dimension_mask.to(keep.device)[:, None])
+    return keep
+
+class RankMixtureLinear(torch.autograd.Function):
+    """
+    y = (act((x A^T + b_a) * s) * s) B^T, with s the nested-rank scale of the gumbel weights.
+    The second scale acts as detached (no arch gradient), as in the masked-copy formulation.
+    Only x, the factors and the K gumbel coefficients are saved; the rank-sized intermediates
+    are recomputed in backward and the arch gradient is the prefix sum of dL/ds at each candidate rank.
+    x: [..., in], weight_a: [r, in], weight_b: [out, r], gumbel_weights: [K], index: [K] ranks clamped to r
+    """
+
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, x, weight_a, weight_b, gumbel_weights, index, bias_a=None, activation=None):
+        scale = _scale_from_index(gumbel_weights, index, weight_a.shape[0])
+        hidden = nn.functional.linear(x, weight_a, bias_a) * scale
+        if activation is not None:
+            hidden = activation(hidden)
+        hidden = hidden * scale
+        ctx.activation = activation
+        ctx.save_for_backward(x, weight_a, weight_b, gumbel_weights, index, bias_a)
+        return nn.functional.linear(hidden, weight_b)
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        x, weight_a, weight_b, gumbel_weights, index, bias_a = ctx.saved_tensors
+        rank = weight_a.shape[0]
+        grad_x = grad_a = grad_b = grad_g = grad_bias = None
+
+        scale = _scale_from_index(gumbel_weights, index, rank)
+        pre = nn.functional.linear(x, weight_a, bias_a)
+        mixed = pre * scale
+        if ctx.activation is not None:
+            with torch.enable_grad():
+                mixed = mixed.detach().requires_grad_()
+                activated = ctx.activation(mixed)
+        else:
+            activated = mixed
+
+        grad_activated = grad_output.matmul(weight_b.to(grad_output.dtype)) * scale
+        if ctx.activation is not None:
+            grad_mixed = torch.autograd.grad(activated, mixed, grad_activated.to(activated.dtype))[0]
+        else:
+            grad_mixed = grad_activated
+        grad_pre = (grad_mixed * scale).reshape(-1, rank)
+
+        if ctx.needs_input_grad[0]:
+            grad_x = grad_pre.matmul(weight_a.to(grad_pre.dtype)).view_as(x).to(x.dtype)
+        if ctx.needs_input_grad[1]:
+            grad_a = grad_pre.t().matmul(x.reshape(-1, x.shape[-1]).to(grad_pre.dtype)).to(weight_a.dtype)
+        if ctx.needs_input_grad[2]:
+            hidden = (activated.detach() * scale).reshape(-1, rank)
+            grad_b = grad_output.reshape(-1, grad_output.shape[-1]).t().matmul(hidden.to(grad_output.dtype)).to(weight_b.dtype)
+        if ctx.needs_input_grad[3]:
+            grad_scale = (grad_mixed * pre).reshape(-1, rank).sum(0)
+            grad_scale = torch.cat([grad_scale.new_zeros(1), grad_scale.cumsum(0)])
+            grad_g = grad_scale[index].to(gumbel_weights.dtype)
+        if bias_a is not None and ctx.needs_input_grad[5]:
+            grad_bias = grad_pre.sum(0).to(bias_a.dtype)
+        return grad_x, grad_a, grad_b, grad_g, None, grad_bias, None
+
+
+def rank_mixture_linear(x, weight_a, weight_b, gumbel_weights, sample_dims, bias_a=None, activation=None):
+    # weight_a: [max_rank, in], weight_b: [out, max_rank]; only the largest sampled rank is touched
+    rank = min(max(sample_dims), weight_a.shape[0])
+    index = _rank_index(sample_dims, rank, gumbel_weights.device)
+    if bias_a is not None:
+        bias_a = bias_a[:rank]
+    return RankMixtureLinear.apply(x, weight_a[:rank, :], weight_b[:, :rank], gumbel_weights, index, bias_a, activation)
+
+
+
+class GroupedRankMixtureLinear(torch.autograd.Function):
+    """
+    RankMixtureLinear for T projections of the same input (q/k/v LoRA): y_t = ((x_t A_t^T) * s_t * s_t) B_t^T.
+    A shared x ([tokens, in]) goes through one GEMM against the concatenated A_t, per-target inputs
+    ([T, tokens, in], e.g. separate dropout masks) through a batched one; the up projections are one bmm.
+    As in RankMixtureLinear only the inputs, factors and gumbel coefficients are saved, the second scale
+    acts as detached and the arch gradient is the prefix sum of dL/ds_t at each candidate rank.
+    weight_a: [T, r, in], weight_b: [T, out, r], gumbel_weights: [T, K], index: [T, K] ranks clamped to r
+    """
+
+    @staticmethod
+    def _down(x, weight_a):
+        if x.dim() == 2:
+            targets, rank = weight_a.shape[:2]
+            return nn.functional.linear(x, weight_a.reshape(targets * rank, -1)).view(-1, targets, rank).transpose(0, 1)
+        return torch.bmm(x, weight_a.transpose(1, 2))
+
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, x, weight_a, weight_b, gumbel_weights, index):
+        rank = weight_a.shape[1]
+        scale = torch.stack([_scale_from_index(g, i, rank) for g, i in zip(gumbel_weights, index)]).unsqueeze(1)
+        hidden = GroupedRankMixtureLinear._down(x, weight_a) * scale * scale  # [T, tokens, r]
+        ctx.save_for_backward(x, weight_a, weight_b, gumbel_weights, index)
+        return torch.bmm(hidden, weight_b.transpose(1, 2).to(hidden.dtype))
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        x, weight_a, weight_b, gumbel_weights, index = ctx.saved_tensors
+        targets, rank = weight_a.shape[:2]
+        grad_x = grad_a = grad_b = grad_g = None
+
+        scale = torch.stack([_scale_from_index(g, i, rank) for g, i in zip(gumbel_weights, index)]).unsqueeze(1)
+        pre = GroupedRankMixtureLinear._down(x, weight_a)
+        grad_mixed = torch.bmm(grad_output, weight_b.to(grad_output.dtype)) * scale
+        grad_pre = grad_mixed * scale  # [T, tokens, r]
+
+        if ctx.needs_input_grad[0]:
+            if x.dim() == 2:
+                grad_x = grad_pre.transpose(0, 1).reshape(-1, targets * rank).matmul(
+                    weight_a.reshape(targets * rank, -1).to(grad_pre.dtype))
+            else:
+                grad_x = torch.bmm(grad_pre, weight_a.to(grad_pre.dtype))
+            grad_x = grad_x.to(x.dtype)
+        if ctx.needs_input_grad[1]:
+            grad_a = torch.matmul(grad_pre.transpose(1, 2), x.to(grad_pre.dtype)).to(weight_a.dtype)
+        if ctx.needs_input_grad[2]:
+            hidden = pre * scale * scale
+            grad_b = torch.bmm(grad_output.transpose(1, 2), hidden.to(grad_output.dtype)).to(weight_b.dtype)
+        if ctx.needs_input_grad[3]:
+            grad_scale = (grad_mixed * pre).sum(1)
+            grad_scale = torch.cat([grad_scale.new_zeros(targets, 1), grad_scale.cumsum(-1)], dim=-1)
+            grad_g = grad_scale.gather(-1, index).to(gumbel_weights.dtype)
+        return grad_x, grad_a, grad_b, grad_g, None
+
+
+def grouped_rank_mixture_linear(x, weights_a, weights_b, gumbel_weights, sample_dims):
+    """
+    x: [..., in] shared by all targets or a list with one input per target; weights_a / weights_b / gumbel_weights /
+    sample_dims: one entry per target. Returns the list of per-target outputs [..., out].
+    """
+    rank = min(max(max(dims) for dims in sample_dims), min(w.shape[0] for w in weights_a))
+    device = gumbel_weights[0].device
+    index = torch.stack([_rank_index(dims, rank, device) for dims in sample_dims])
+    if isinstance(x, (list, tuple)):
+        lead_shape = x[0].shape[:-1]
+        x = torch.stack([t.reshape(-1, t.shape[-1]) for t in x])
+    else:
+        lead_shape = x.shape[:-1]
+        x = x.reshape(-1, x.shape[-1])
+    out = GroupedRankMixtureLinear.apply(x, torch.stack([w[:rank, :] for w in weights_a]),
+                                         torch.stack([w[:, :rank] for w in weights_b]),
+                                         torch.stack(list(gumbel_weights)), index)
+    return [o.view(*lead_shape, o.shape[-1]) for o in out.unbind(0)]
+
+def nested_bottleneck_forward(hiddens, down_proj, up_proj, non_linear, gumbel_weights, sample_dims):
+    """
+    Gumbel-weighted mixture over nested bottleneck widths of a down-act-up adapter without per-candidate
+    weight copies: the down projection (and its bias) is scaled by the cumulative weights, the up projection
+    input by the detached ones, matching the masked-copy formulation of SA/PA adapters.
+    """
+    return rank_mixture_linear(hiddens, down_proj.weight, up_proj.weight, gumbel_weights, sample_dims,
+                               bias_a=down_proj.bias, activation=non_linear) + up_proj.bias
+
+def _has_tanh_gelu():
+    try:
+        nn.functional.gelu(torch.zeros(1), approximate='tanh')
+        return True
+    except TypeError:
+        return False
+
+
+_TANH_GELU = _has_tanh_gelu()
+
+
+class GeluNewFunction(torch.autograd.Function):
+    """
+    gelu_new for torch builds whose F.gelu has no tanh approximation: only the input is saved,
+    the tanh term is recomputed in backward instead of keeping the pow/tanh intermediates.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        ctx.save_for_backward(x)
+        return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * x * x * x)))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        c = math.sqrt(2 / math.pi)
+        t = torch.tanh(c * (x + 0.044715 * x * x * x))
+        grad = 0.5 * (1 + t) + 0.5 * x * (1 - t * t) * c * (1 + 3 * 0.044715 * x * x)
+        return grad_output * grad
+
+
 class Activations(nn.Module):
     """
     Implementation of various activation function. Copied from open-source project AdapterHub
@@ -24,21 +273,14 @@ class Activations(nn.Module):
         elif activation_type.lower() == "tanh":
             self.f = torch.tanh
         elif activation_type.lower() == "swish":
-
-            def swish(x):
-                return x * torch.sigmoid(x)
-
-            self.f = swish
+            # fused x * sigmoid(x), backward only keeps the input
+            self.f = nn.functional.silu
         elif activation_type.lower() == "gelu_new":
-
-            def gelu_new(x):
-                """
-                Implementation of the gelu activation function currently in Google Bert repo (identical to OpenAI GPT).
-                Also see https://arxiv.org/abs/1606.08415
-                """
-                return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
-
-            self.f = gelu_new
+            # gelu_new of the Google Bert repo (https://arxiv.org/abs/1606.08415), i.e. the tanh approximation
+            if _TANH_GELU:
+                self.f = partial(nn.functional.gelu, approximate='tanh')
+            else:
+                self.f = GeluNewFunction.apply
         elif activation_type.lower() == "gelu_orig":
             self.f = nn.functional.gelu
         elif activation_type.lower() == "leakyrelu":
@@ -133,17 +375,16 @@ class LowRankLinear(torch.nn.Module):
         self.main_forward = main_forward
 
         if gumbel_weights is not None:
-            w_a_sampled, w_b_sampled = (
-                self.sample_lora(self.W_left, self.W_right, gumbel_weights=gumbel_weights,
-                                 dimension_mask=dimension_mask))
-            W = w_a_sampled @ w_b_sampled
+            search_lora_dim = get_search_dims(self.candidate_dims, self.candidate_dims_binary, self.iterative_order,
+                                              self.main_forward, given_max_rank_id=dimension_mask)
+            output = rank_mixture_linear(x, self.W_left.t(), self.W_right.t(), gumbel_weights, search_lora_dim)
         else:
+            # apply the factors in sequence instead of materializing W_left @ W_right
             if dim_choice is not None:
-                W = self.W_left[:, :dim_choice] @ self.W_right[:dim_choice, :]
+                output = torch.matmul(torch.matmul(x, self.W_left[:, :dim_choice]), self.W_right[:dim_choice, :])
             else:
-                W = self.W_left @ self.W_right
+                output = torch.matmul(torch.matmul(x, self.W_left), self.W_right)
 
-        output = torch.matmul(input=x, other=W)
         if self.bias:
             if gumbel_weights is not None and gumbel_weights.shape[0] == 2:
                 output += self.b * gumbel_weights[1] #  if selected at binary stage
@@ -151,41 +392,56 @@ class LowRankLinear(torch.nn.Module):
                 output += self.b
         return output
 
-    def sample_lora(self, w_a, w_b, gumbel_weights=None, dimension_mask=None):
-        stacked_samples = self.sample_weights(w_a, w_b, dimension_mask=dimension_mask)
-        (sampled_w_a, sampled_w_b) = stacked_samples
-        gumbel_weights = gumbel_weights.unsqueeze(-1).unsqueeze(-1)
-        # print(self.iterative_order, gumbel_weights, sampled_w_a,'jj')
-        w_a_sampled = torch.sum(gumbel_weights * sampled_w_a, dim=0)
-        w_b_sampled = torch.sum(gumbel_weights.detach() * sampled_w_b, dim=0)
-
-        return w_a_sampled, w_b_sampled
-
-    def sample_weights(self, w_a, w_b, dimension_mask=None):
-        (sampled_w_a, sampled_w_b) = (
-            self.sample_weights_single(w_a, "a", given_max_rank_id=dimension_mask), self.sample_weights_single(w_b, "b", given_max_rank_id=dimension_mask)
-        )
-        return sampled_w_a.cuda(), sampled_w_b.cuda()
-
-    def sample_weights_single(self, w, type="a", given_max_rank_id=None):
-        if w is None:
-            return None
-        ws = []
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            search_lora_dim = self.candidate_dims_binary
-            if given_max_rank_id is not None:
-                search_lora_dim[1] = self.candidate_dims[given_max_rank_id]
-        else:
-            search_lora_dim = self.candidate_dims
-
-        for sample_dim in search_lora_dim:
-            # Set non-sampled weights to zero, different with lora
-            mask_weight = torch.zeros_like(w)
-            if type == "a":
-                mask_weight[:, :sample_dim] = 1
-            elif type == "b":
-                mask_weight[:sample_dim, :] = 1
-            sampled_weight = mask_weight * w
-            ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
+
+class Int8Linear(nn.Module):
+    """
+    Frozen nn.Linear stored as int8 with one scale per output row (weight-only, symmetric). The forward
+    dequantizes on the fly, x @ W_int8^T * scale, so gradients still reach the input and the PEFT branches
+    around it. mode='dynamic' additionally runs torch's dynamically quantized int8 kernel for CPU inference
+    without autograd (packed on first use, not saved).
+    """
+    def __init__(self, linear: nn.Linear, mode='weight'):
+        super().__init__()
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        self.mode = mode
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer('weight', torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        self.register_buffer('weight_scale', scale)
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().clone())
+        self.packed = None
+
+    def pack(self):
+        # fbgemm per-channel qint8 weights of the same int8 values and scales
+        scale = self.weight_scale.float().cpu()
+        qweight = torch._make_per_channel_quantized_tensor(self.weight.cpu(), scale, torch.zeros_like(scale, dtype=torch.long), 0)
+        packed = torch.ao.nn.quantized.dynamic.Linear(self.in_features, self.out_features, bias_=self.bias is not None, dtype=torch.qint8)
+        packed.set_weight_bias(qweight, None if self.bias is None else self.bias.float().cpu())
+        return packed
+
+    def forward(self, x):
+        if self.mode == 'dynamic' and x.device.type == 'cpu' and not torch.is_grad_enabled():
+            if self.packed is None:
+                self.packed = self.pack()
+            return self.packed(x.float()).to(x.dtype)
+        output = torch.nn.functional.linear(x, self.weight.to(x.dtype)) * self.weight_scale.to(x.dtype)
+        if self.bias is not None:
+            output = output + self.bias.to(x.dtype)
+        return output
+
+    def _apply(self, fn, *args, **kwargs):
+        # the packed kernel is cpu only, repack after a move
+        self.packed = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, mode={self.mode}"
+
+
+def quantize_linears(module, mode='weight', names=('q', 'k', 'v', 'o', 'wi', 'wo', 'wi_0', 'wi_1')):
+    # replace the (frozen) nn.Linear children with these names by Int8Linear, in place
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if name in names and type(child) is nn.Linear:
+                setattr(parent, name, Int8Linear(child, mode=mode))
+    return module
@@ -5,7 +5,89 @@ import numpy as np
 import math
 import time
 
-from .peft_layers import Activations, LowRankLinear
+from .peft_layers import Activations, LowRankLinear, get_search_dims, rank_mixture_linear, \
+    grouped_rank_mixture_linear, nested_bottleneck_forward, prefix_keep_weight, t5_rms_normalize, Int8Linear
+
+
+PLAN_BRANCHES = ('lora', 'adapter', 'bitfit', 'lnfit', 'sa', 'pa')
+
+
+
+def param_versions(*modules):
+    # in-place updates (optimizer step, load_state_dict, merge) bump the version, replaced parameters change id
+    return tuple((id(p), p._version) for module in modules for p in module.parameters())
+
+
+class PrefixKVCache(object):
+    """
+    Prefix tensors computed without autograd (eval, generate), reused until their key changes: the versions
+    of the parameters they come from, or clear() after freeze_arch.
+    """
+    def __init__(self):
+        self.key, self.value = None, None
+
+    def get(self, key, compute):
+        if self.key is None or self.key != key:
+            self.key, self.value = key, compute()
+        return self.value
+
+    def clear(self):
+        self.key, self.value = None, None
+
+class PEFTDispatchPlan(object):
+    """
+    Gumbel weights and dimension masks of one search step, split once into per-layer/per-slot views.
+    Every Mix_PEFT reads its own (key, layer, slot) entries, so the forward no longer rebuilds and slices
+    the gumbel/mask dicts at every block.
+    """
+    def __init__(self):
+        self.gumbel, self.mask = dict(), dict()
+        self.iterative_order, self.main_forward = None, None
+        self.active = False
+
+    @staticmethod
+    def split(weights, depth):
+        if weights is None:
+            return None
+        if depth == 1:
+            return weights.unbind(0)
+        return [rows.unbind(0) for rows in weights.unbind(0)]
+
+    def update(self, gumbel_weights_all_dict, dimension_mask, iterative_order=None, main_forward=None):
+        # matrix/binary weights: [layers, slots, candidates], final_norm: [slots, 2], masks: [layers, slots]
+        self.gumbel = {key: self.split(gumbel_weights_all_dict[key], 2)
+                       for key in ["encoder", "decoder", "encoder_binary", "decoder_binary"]}
+        self.gumbel["final_norm"] = self.split(gumbel_weights_all_dict["final_norm"], 1)
+        self.mask = dict()
+        if dimension_mask is not None:
+            self.mask = {key: self.split(dimension_mask[key + "_dimension_mask"], 2) for key in ["encoder", "decoder"]}
+        self.iterative_order, self.main_forward = iterative_order, main_forward
+        self.active = True
+
+    def clear(self):
+        self.gumbel, self.mask = dict(), dict()
+        self.active = False
+
+    @staticmethod
+    def lookup(views, key, layer, slot):
+        rows = views.get(key)
+        if rows is None:
+            return None
+        if layer is not None:
+            rows = rows[layer]
+        return rows[slot]
+
+    def read(self, slots):
+        # slots: (key, layer, slot) of each branch in PLAN_BRANCHES order, None for a missing branch
+        gumbel_weights, dimension_mask = [], []
+        for slot in slots:
+            if slot is None:
+                gumbel_weights.append(None)
+                dimension_mask.append(None)
+            else:
+                gumbel_weights.append(self.lookup(self.gumbel, *slot))
+                dimension_mask.append(self.lookup(self.mask, *slot))
+        return gumbel_weights, dimension_mask
 
 
 class Mix_PEFT(nn.Module):
@@ -35,9 +117,25 @@ class Mix_PEFT(nn.Module):
         self.args = args
         self.add_peft_modules()
         self.name=name
+        # a wrapped T5LayerNorm with LNfit is run as one RMSNorm with weight (w + g * LNfit_weight)
+        self.fuse_norm = add_lnfit and not (add_lora or add_adapter or add_SA or add_PA) \
+                         and hasattr(original_module, 'variance_epsilon') and hasattr(original_module, 'weight')
 
         self.is_main_module = is_main_module
 
+        # sparse execution: gumbel slot of each branch, branches whose sampled "on" weights are all zero
+        # at this step, and running output estimates used as their straight-through stand-ins
+        self.peft_slots = dict()
+        self.skip_branches = dict()
+        self.branch_output_ema = dict()
+        self.sparse_exec = False
+        # shared PEFTDispatchPlan, read when the caller passes no gumbel weights during a search step
+        self.dispatch_plan = None
+        self.plan_slots = None
+        # merge_peft: LoRA/LNfit folded into the wrapped weight, BitFit into its bias (merged_bias if it has none)
+        self.merged = False
+        self.merged_bias, self.merged_linear_bias = None, False
+
 
     def freeze_arch(self, finalized_weight=None, retrain_flag=False):
 
@@ -48,6 +146,129 @@ class Mix_PEFT(nn.Module):
                 if module is not None:
                     module.freeze_arch(finalized_weight=self.finalized_weight[name], retrain_flag=retrain_flag)
 
+    def set_sparse_branches(self, active_masks):
+        # active_masks: {gumbel key: (host bool array [layers, slots] or [slots], index of the first "on" candidate)}
+        self.sparse_exec = True
+        self.skip_branches = dict()
+        for branch, (key, layer, slot) in self.peft_slots.items():
+            if key not in active_masks:
+                continue
+            active, on_start = active_masks[key]
+            if layer is not None:
+                active = active[layer]
+            if not active[slot]:
+                self.skip_branches[branch] = on_start
+
+    @staticmethod
+    def branch_selected(module):
+        # False only for a finalized branch that adds nothing to the output
+        if module is None:
+            return False
+        if getattr(module, 'fix_weight', None) is None:
+            return True
+        if module.binary_choice == 0:
+            return False
+        return not (isinstance(module, LowRankAdapterSequentialLayer) and module.dim_choice == 0)
+
+    def mergeable(self):
+        # int8 weights cannot absorb the LoRA delta
+        if isinstance(self.original_module, Int8Linear):
+            return False
+        return not any(self.branch_selected(module) for module in [self.adapter, self.sadapter, self.padapter])
+
+    def merge(self):
+        module = self.original_module
+        with torch.no_grad():
+            lora_weight = self.lora.merged_weight() if self.lora is not None else None
+            if lora_weight is not None:
+                module.weight += lora_weight.to(module.weight.dtype)
+            lnfit_weight = self.lnfit.scaled_weight() if self.lnfit is not None else None
+            if lnfit_weight is not None:
+                module.weight += lnfit_weight.to(module.weight.dtype)
+            bias = self.bitfit.merged_bias() if self.bitfit is not None else None
+            if bias is not None:
+                if isinstance(module, nn.Linear) and module.bias is None:
+                    module.bias = nn.Parameter(bias.detach().clone().to(module.weight.dtype), requires_grad=False)
+                    self.merged_linear_bias = True
+                else:
+                    # T5 layer norms have no bias, it is added after the norm
+                    self.merged_bias = bias
+        self.merged = True
+
+    def unmerge(self):
+        module = self.original_module
+        with torch.no_grad():
+            lora_weight = self.lora.merged_weight() if self.lora is not None else None
+            if lora_weight is not None:
+                module.weight -= lora_weight.to(module.weight.dtype)
+            lnfit_weight = self.lnfit.scaled_weight() if self.lnfit is not None else None
+            if lnfit_weight is not None:
+                module.weight -= lnfit_weight.to(module.weight.dtype)
+            if self.merged_linear_bias:
+                module.bias = None
+        self.merged_bias, self.merged_linear_bias = None, False
+        self.merged = False
+
+    @property
+    def plan_active(self):
+        return self.dispatch_plan is not None and self.dispatch_plan.active
+
+    def read_plan(self):
+        if self.plan_slots is None:
+            self.plan_slots = [self.peft_slots.get(branch) for branch in PLAN_BRANCHES]
+        return self.dispatch_plan.read(self.plan_slots)
+
+    def planned_branch(self, branch):
+        gumbel_weights, dimension_mask = self.read_plan()
+        idx = PLAN_BRANCHES.index(branch)
+        return gumbel_weights[idx], dimension_mask[idx]
+
+    def skip_branch(self, branch, gumbel_weights):
+        return gumbel_weights is not None and branch in self.skip_branches and branch in self.branch_output_ema
+
+    def branch_surrogate(self, branch, gumbel_weights):
+        # exactly zero in value; the "on" weights still get d(loss)/dg against the running output estimate
+        gumbel_on = gumbel_weights[..., self.skip_branches[branch]:].sum()
+        return (gumbel_on - gumbel_on.detach()) * self.branch_output_ema[branch]
+
+    def record_branch_output(self, branch, output):
+        if not self.sparse_exec or not isinstance(output, torch.Tensor):
+            return
+        with torch.no_grad():
+            output_mean = output.detach().float().reshape(-1, output.shape[-1]).mean(0)
+            if branch in self.branch_output_ema:
+                output_mean = 0.9 * self.branch_output_ema[branch].float() + 0.1 * output_mean
+            self.branch_output_ema[branch] = output_mean.to(output.dtype)
+
+    def fused_norm_forward(self, x, gumbel_weights_lnfit=None, gumbel_weights_bitfit=None):
+        # same as norm(x) + lnfit(x) (+ bitfit), but the RMS statistics are computed once
+        norm = self.original_module
+        bias = None
+        if self.add_bitfit:
+            if self.skip_branch('bitfit', gumbel_weights_bitfit):
+                bias = self.branch_surrogate('bitfit', gumbel_weights_bitfit)
+            else:
+                bias = self.bitfit(x, gumbel_weights=gumbel_weights_bitfit)
+                self.record_branch_output('bitfit', bias)
+
+        weight, lnfit_weight = norm.weight, None
+        if self.skip_branch('lnfit', gumbel_weights_lnfit):
+            surrogate = self.branch_surrogate('lnfit', gumbel_weights_lnfit)
+            bias = surrogate if bias is None else bias + surrogate
+        else:
+            lnfit_weight = self.lnfit.scaled_weight(gumbel_weights_lnfit)
+            if lnfit_weight is not None:
+                weight = weight + lnfit_weight
+
+        hidden_states = self.lnfit.normalize(x, eps=norm.variance_epsilon, dtype=norm.weight.dtype)
+        if self.sparse_exec and lnfit_weight is not None:
+            self.record_branch_output('lnfit', lnfit_weight * hidden_states.reshape(-1, hidden_states.shape[-1]).mean(0))
+
+        hidden_states = weight * hidden_states
+        if isinstance(bias, torch.Tensor):
+            hidden_states += bias
+        return hidden_states
+
     def add_peft_modules(self):
         if self.add_lora:
             self.lora = LoRA_ParallelLayer(LoRA_a=self.lora_modules[0], LoRA_b=self.lora_modules[1], candidate_dims=self.candidate_dims,
@@ -67,8 +288,15 @@ class Mix_PEFT(nn.Module):
         if self.add_PA:
             self.padapter = PAdapterLayer(hidden_dim=self.hidden_dim, candidate_dims=self.candidate_dims)
 
-    def forward(self, x, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None, *args, **kwargs):
+    def forward(self, x, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None, lora_output=None, *args, **kwargs):
         # we expect that the gumbel_weights and dimension_mask are all in dict version
+        # lora_output: LoRA branch already computed by the caller (grouped q/k/v projection)
+        if self.merged:
+            hidden_flow = self.original_module(x, *args, **kwargs)
+            return hidden_flow if self.merged_bias is None else hidden_flow + self.merged_bias
+        planned = gumbel_weights is None and self.plan_active
+        if planned:
+            iterative_order, main_forward = self.dispatch_plan.iterative_order, self.dispatch_plan.main_forward
         self.iterative_order = iterative_order
         self.main_forward = main_forward
         gumbel_weights_lora, gumbel_weights_adapter, gumbel_weights_bitfit, gumbel_weights_lnfit, gumbel_weights_sa, gumbel_weights_pa = [None]*6
@@ -83,6 +311,9 @@ class Mix_PEFT(nn.Module):
             if gumbel_weights.__contains__('sa'):
                 gumbel_weights_sa = gumbel_weights['sa']
                 gumbel_weights_pa = gumbel_weights['pa']
+        elif planned:
+            (gumbel_weights_lora, gumbel_weights_adapter, gumbel_weights_bitfit, gumbel_weights_lnfit, gumbel_weights_sa, gumbel_weights_pa), \
+                (dimension_mask_lora, dimension_mask_adapter, _, _, dimension_mask_sa, dimension_mask_pa) = self.read_plan()
 
         if dimension_mask is not None:
             dimension_mask_lora = dimension_mask['lora']
@@ -93,8 +324,11 @@ class Mix_PEFT(nn.Module):
                 dimension_mask_sa = dimension_mask['sa']
                 dimension_mask_pa = dimension_mask['pa']
 
+        if self.fuse_norm:
+            return self.fused_norm_forward(x, gumbel_weights_lnfit=gumbel_weights_lnfit, gumbel_weights_bitfit=gumbel_weights_bitfit)
+
         #forward-order: lora, lnfit, bitfit, adapter
-        if self.adapter is not None and gumbel_weights is not None:
+        if self.adapter is not None and (gumbel_weights is not None or planned):
             hidden_flow = self.original_module(x, iterative_order=iterative_order, main_forward=main_forward, *args, **kwargs)
         else:
             #this case: for self-attn module forward
@@ -105,17 +339,36 @@ class Mix_PEFT(nn.Module):
                 hidden_flow = self.original_module(x, *args, **kwargs)
         #parallel
         if self.add_lora:
-            lora_output = self.lora(x, gumbel_weights=gumbel_weights_lora, dimension_mask=dimension_mask_lora, iterative_order=iterative_order, main_forward=main_forward)
+            if lora_output is not None:
+                self.record_branch_output('lora', lora_output)
+            elif self.skip_branch('lora', gumbel_weights_lora):
+                lora_output = self.branch_surrogate('lora', gumbel_weights_lora)
+            else:
+                lora_output = self.lora(x, gumbel_weights=gumbel_weights_lora, dimension_mask=dimension_mask_lora, iterative_order=iterative_order, main_forward=main_forward)
+                self.record_branch_output('lora', lora_output)
             hidden_flow = hidden_flow + lora_output
         if self.add_lnfit:
-            lnfit_out = self.lnfit(x, gumbel_weights=gumbel_weights_lnfit)
+            if self.skip_branch('lnfit', gumbel_weights_lnfit):
+                lnfit_out = self.branch_surrogate('lnfit', gumbel_weights_lnfit)
+            else:
+                lnfit_out = self.lnfit(x, gumbel_weights=gumbel_weights_lnfit)
+                self.record_branch_output('lnfit', lnfit_out)
             hidden_flow = hidden_flow + lnfit_out
         #sequential
         if self.add_bitfit:
-            bitfit_out = self.bitfit(hidden_flow, gumbel_weights=gumbel_weights_bitfit)
-            hidden_flow = hidden_flow + bitfit_out
+            if self.skip_branch('bitfit', gumbel_weights_bitfit):
+                bitfit_out = self.branch_surrogate('bitfit', gumbel_weights_bitfit)
+            else:
+                bitfit_out = self.bitfit(hidden_flow, gumbel_weights=gumbel_weights_bitfit)
+                self.record_branch_output('bitfit', bitfit_out)
+            # bitfit_out is a broadcast [hidden] vector, hidden_flow is a fresh activation here
+            hidden_flow += bitfit_out
         if self.add_adapter:
-            adapter_out = self.adapter(hidden_flow, gumbel_weights=gumbel_weights_adapter, dimension_mask=dimension_mask_adapter, iterative_order=iterative_order, main_forward=main_forward, **kwargs)
+            if self.skip_branch('adapter', gumbel_weights_adapter):
+                adapter_out = self.branch_surrogate('adapter', gumbel_weights_adapter)
+            else:
+                adapter_out = self.adapter(hidden_flow, gumbel_weights=gumbel_weights_adapter, dimension_mask=dimension_mask_adapter, iterative_order=iterative_order, main_forward=main_forward, **kwargs)
+                self.record_branch_output('adapter', adapter_out)
             if isinstance(adapter_out, torch.Tensor) and isinstance(hidden_flow, torch.Tensor):
                 hidden_flow = hidden_flow + adapter_out
             elif isinstance(hidden_flow, tuple):
@@ -126,14 +379,22 @@ class Mix_PEFT(nn.Module):
                 hidden_flow = hidden_flow
 
         if self.add_SA:
-            SA_adapter_out = self.sadapter(hidden_flow, gumbel_weights=gumbel_weights_sa, dimension_mask=dimension_mask_sa, iterative_order=iterative_order, main_forward=main_forward, **kwargs)
+            if self.skip_branch('sa', gumbel_weights_sa):
+                SA_adapter_out = self.branch_surrogate('sa', gumbel_weights_sa)
+            else:
+                SA_adapter_out = self.sadapter(hidden_flow, gumbel_weights=gumbel_weights_sa, dimension_mask=dimension_mask_sa, iterative_order=iterative_order, main_forward=main_forward, **kwargs)
+                self.record_branch_output('sa', SA_adapter_out)
             if not self.add_PA:
                 hidden_flow = hidden_flow + SA_adapter_out
             else:
                 SA_adapter_out = hidden_flow + SA_adapter_out
         if self.add_PA:
             #different with SA: use x instead of hidden_flow
-            PA_adapter_out = self.padapter(x, gumbel_weights=gumbel_weights_pa, dimension_mask=dimension_mask_pa, iterative_order=iterative_order, main_forward=main_forward, **kwargs)
+            if self.skip_branch('pa', gumbel_weights_pa):
+                PA_adapter_out = self.branch_surrogate('pa', gumbel_weights_pa)
+            else:
+                PA_adapter_out = self.padapter(x, gumbel_weights=gumbel_weights_pa, dimension_mask=dimension_mask_pa, iterative_order=iterative_order, main_forward=main_forward, **kwargs)
+                self.record_branch_output('pa', PA_adapter_out)
             if self.add_SA:
                 PA_adapter_out = PA_adapter_out + SA_adapter_out
             else:
@@ -199,16 +460,6 @@ class LoRA_ParallelLayer(nn.Module):
             del self.LoRA_b
             del self.LoRA_a
 
-    def sample_lora(self, w_a, w_b, gumbel_weights=None, dimension_mask=None):
-        stacked_samples = self.sample_weights(w_a, w_b, dimension_mask=dimension_mask)
-        (sampled_w_a, sampled_w_b) = stacked_samples
-        gumbel_weights = gumbel_weights.unsqueeze(-1).unsqueeze(-1)
-        # print(self.iterative_order, gumbel_weights, sampled_w_a,'jj')
-        w_a_sampled = torch.sum(gumbel_weights * sampled_w_a, dim=0)
-        w_b_sampled = torch.sum(gumbel_weights.detach() * sampled_w_b, dim=0)
-
-        return w_a_sampled, w_b_sampled
-
     def forward(self, x, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None):
         self.iterative_order = iterative_order
         self.main_forward = main_forward
@@ -219,9 +470,10 @@ class LoRA_ParallelLayer(nn.Module):
                 return 0
             return x
         if gumbel_weights is not None:
-            w_a_sampled, w_b_sampled = (
-                self.sample_lora(self.LoRA_a.weight, self.LoRA_b.weight, gumbel_weights=gumbel_weights, dimension_mask=dimension_mask))
-            x = F.linear(input=F.linear(self.LoRA_dropout(x), weight=w_a_sampled), weight=w_b_sampled)
+            # nested candidate ranks: one down-scale-up product, see RankMixtureLinear
+            search_lora_dim = get_search_dims(self.candidate_dims, self.candidate_dims_binary, iterative_order,
+                                              main_forward, given_max_rank_id=dimension_mask)
+            x = rank_mixture_linear(self.LoRA_dropout(x), self.LoRA_a.weight, self.LoRA_b.weight, gumbel_weights, search_lora_dim)
         elif self.fix_weight is not None:
             if self.binary_choice == 1:
                 w_a_sampled, w_b_sampled = self.LoRA_a.weight[:self.dim_choice, :], self.LoRA_b.weight[:, :self.dim_choice]
@@ -232,35 +484,17 @@ class LoRA_ParallelLayer(nn.Module):
             x = self.LoRA_b(self.LoRA_a(self.LoRA_dropout(x)))
         return x
 
-    def sample_weights(self, w_a, w_b, dimension_mask=None):
-        (sampled_w_a, sampled_w_b) = (
-            self.sample_weights_single(w_a, "a", given_max_rank_id=dimension_mask), self.sample_weights_single(w_b, "b", given_max_rank_id=dimension_mask)
-        )
-        return sampled_w_a.cuda(), sampled_w_b.cuda()
-
-    def sample_weights_single(self, w, type="a", given_max_rank_id=None):
-        if w is None:
+    def merged_weight(self):
+        # dense B @ A of the branch as the non-search forward runs it, None if it adds nothing
+        if not hasattr(self, 'LoRA_a') or (self.fix_weight is not None and self.binary_choice == 0):
             return None
-        ws = []
-        # print(self.iterative_order, self.main_forward)
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            search_lora_dim = self.candidate_dims_binary
-            if given_max_rank_id is not None:
-                search_lora_dim[1] = self.candidate_dims[given_max_rank_id]
-        else:
-            search_lora_dim = self.candidate_dims
-
-        for sample_dim in search_lora_dim:
-            # Set non-sampled weights to zero
-            mask_weight = torch.zeros_like(w)
-            if type == "a":
-                mask_weight[:sample_dim, :] = 1
-            elif type == "b":
-                mask_weight[:, :sample_dim] = 1
-            sampled_weight = mask_weight * w
-            ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
+        w_a, w_b = self.LoRA_a.weight, self.LoRA_b.weight
+        if self.fix_weight is not None:
+            w_a, w_b = w_a[:self.dim_choice, :], w_b[:, :self.dim_choice]
+        if w_a.shape[0] == 0:
+            return None
+        return w_b @ w_a
+
     def calc_sampled_param_num(self):
         assert 'weight' in self.samples.keys()
         weight_numel = self.samples['weight'].numel()
@@ -277,6 +511,21 @@ class LoRA_ParallelLayer(nn.Module):
         return total_flops
 
 
+def grouped_lora_forward(lora_layers, x, gumbel_weights, dimension_masks, iterative_order=None, main_forward=None):
+    """
+    LoRA branches of several projections of the same input (q/k/v) in two GEMMs: the LoRA_a weights are
+    concatenated into one down projection, the per-target up projections run as one batched matmul.
+    Each target keeps its own nested-rank scale and its own dropout mask, as in LoRA_ParallelLayer;
+    the input is only shared when dropout is a no-op (eval or dropout=0).
+    """
+    search_dims = [get_search_dims(layer.candidate_dims, layer.candidate_dims_binary, iterative_order, main_forward,
+                                   given_max_rank_id=mask) for layer, mask in zip(lora_layers, dimension_masks)]
+    if any(layer.LoRA_dropout.training and layer.LoRA_dropout.p > 0 for layer in lora_layers):
+        x = [layer.LoRA_dropout(x) for layer in lora_layers]
+    return grouped_rank_mixture_linear(x, [layer.LoRA_a.weight for layer in lora_layers],
+                                       [layer.LoRA_b.weight for layer in lora_layers], gumbel_weights, search_dims)
+
+
 class BitFitParallelLayer(nn.Module):
     def __init__(self, hidden_dim, init_method="zero"):
         super().__init__()
@@ -300,6 +549,11 @@ class BitFitParallelLayer(nn.Module):
         if self.binary_choice == 0:
             del self.BitFit_bias
 
+    def merged_bias(self):
+        if self.binary_choice == 0:
+            return None
+        return self.BitFit_bias
+
     def instantiate(self, hidden_dim):
         if self.init_method == "zero":
             self.BitFit_bias = nn.Parameter(torch.zeros(hidden_dim))
@@ -308,34 +562,19 @@ class BitFitParallelLayer(nn.Module):
         self.instantiated = True
 
     def forward(self, output, gumbel_weights=None):
+        # returns the [hidden] bias, broadcast by the caller instead of a full activation-sized tensor
         if gumbel_weights is None and self.binary_choice == 0:
             return 0
 
-        #here, gumbel weights are like [1, 0]
-        if isinstance(output, tuple):
-            hiddens = output[0]
-        elif isinstance(output, torch.Tensor):
-            hiddens = output
-        else:
-            raise TypeError
-
-
         if not self.instantiated:
+            hiddens = output[0] if isinstance(output, tuple) else output
             self.hidden_dim = hiddens.shape[-1]
             # print(f"Got hidden dim hidden_dim {self.hidden_dim}")
             self.instantiate(hidden_dim=self.hidden_dim)
+        #here, gumbel weights are like [1, 0]
         if gumbel_weights is not None:
-            modified_output = torch.zeros_like(hiddens) + torch.sum(gumbel_weights.unsqueeze(-1) * torch.stack([torch.zeros_like(self.BitFit_bias).cuda(), self.BitFit_bias]), dim=0)
-        else:
-            modified_output = torch.zeros_like(hiddens) + self.BitFit_bias
-
-        if isinstance(output, tuple):
-            output = (modified_output,) + output[1:]
-        elif isinstance(output, torch.Tensor):
-            output = modified_output
-        else:
-            raise TypeError
-        return output
+            return gumbel_weights[1] * self.BitFit_bias
+        return self.BitFit_bias
 
 
 class LowRankAdapterSequentialLayer(nn.Module):
@@ -484,6 +723,17 @@ class T5LayerNormParalleyLayer(nn.Module):
             raise NotImplementedError
         self.instantiated = True
 
+    def normalize(self, hidden_states, eps=None, dtype=None):
+        return t5_rms_normalize(hidden_states, self.variance_epsilon if eps is None else eps,
+                                self.LNfit_weight.dtype if dtype is None else dtype)
+
+    def scaled_weight(self, gumbel_weights=None):
+        if gumbel_weights is None and self.binary_choice == 0:
+            return None
+        if gumbel_weights is not None:
+            return gumbel_weights[1] * self.LNfit_weight
+        return self.LNfit_weight
+
     def forward(self, hidden_states, gumbel_weights=None):
 
         if gumbel_weights is None and self.binary_choice == 0:
@@ -493,17 +743,7 @@ class T5LayerNormParalleyLayer(nn.Module):
             self.hidden_dim = hidden_states.shape[-1]
             self.instantiate(hidden_dim=self.hidden_dim)
 
-        variance = hidden_states.to(torch.float32).pow(2).mean(-1, keepdim=True)
-        hidden_states = hidden_states * torch.rsqrt(variance + self.variance_epsilon)
-
-        # convert into half-precision if necessary
-        if self.LNfit_weight.dtype in [torch.float16, torch.bfloat16]:
-            hidden_states = hidden_states.to(self.LNfit_weight.dtype)
-
-        if gumbel_weights is not None:
-            weighted_LNfit_weight = torch.sum(gumbel_weights.unsqueeze(-1) * torch.stack([torch.zeros_like(self.LNfit_weight).cuda(), self.LNfit_weight]), dim=0)
-            return weighted_LNfit_weight * hidden_states
-        return self.LNfit_weight * hidden_states
+        return self.scaled_weight(gumbel_weights) * self.normalize(hidden_states)
 
 
 class SAdapterLayer(nn.Module):
@@ -570,17 +810,6 @@ class SAdapterLayer(nn.Module):
             if module.bias is not None:
                 module.bias.data.zero_()
 
-    def sample_adapter(self, w_a, w_b, bias, gumbel_weights=None, dimension_mask=None):
-        stacked_samples = self.sample_weights(w_a, w_b, bias, dimension_mask=dimension_mask)
-        (sampled_w_a, sampled_w_b, sampled_bias) = stacked_samples
-        gumbel_weights = gumbel_weights.unsqueeze(-1).unsqueeze(-1)
-        # print(self.iterative_order, gumbel_weights, sampled_w_a,'jj')
-        w_a_sampled = torch.sum(gumbel_weights * sampled_w_a, dim=0)
-        w_b_sampled = torch.sum(gumbel_weights.detach() * sampled_w_b, dim=0)
-        bias_sampled = torch.sum(gumbel_weights.squeeze(-1) * sampled_bias, dim=0)
-
-        return w_a_sampled, w_b_sampled, bias_sampled
-
     def forward(self, output, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None, **kwargs):
         r""" Get the hidden_states from the PLM's layer output, pass it into the adapter,
         then combined with the main hidden_states. Finally pass it into the subsequent layer.
@@ -605,13 +834,10 @@ class SAdapterLayer(nn.Module):
             return x
 
         if gumbel_weights is not None:
-            # t1 = time.time()
-            w_a_sampled, w_b_sampled, bias_sampled = (
-                self.sample_adapter(self.down_proj.weight, self.up_proj.weight, bias=self.down_proj.bias, gumbel_weights=gumbel_weights,
-                                    dimension_mask=dimension_mask))
-            x = F.linear(hiddens, weight=w_a_sampled, bias=bias_sampled)
-            x = self.non_linear(x)
-            adapter_output = F.linear(x, weight=w_b_sampled, bias=self.up_proj.bias)
+            search_dims = get_search_dims(self.candidate_dims, self.candidate_dims_binary, iterative_order,
+                                          main_forward, given_max_rank_id=dimension_mask)
+            adapter_output = nested_bottleneck_forward(hiddens, self.down_proj, self.up_proj, self.non_linear,
+                                                       gumbel_weights, search_dims)
         elif self.fix_weight is not None:
             if self.binary_choice == 1:
                 w_a_sampled, w_b_sampled = self.down_proj.weight[:self.dim_choice, :], self.up_proj.weight[:,
@@ -629,54 +855,6 @@ class SAdapterLayer(nn.Module):
 
         return adapter_output
 
-    def sample_weights(self, w_a, w_b, bias, dimension_mask=None):
-        (sampled_w_a, sampled_w_b) = (
-            self.sample_weights_single(w_a, "a", given_max_rank_id=dimension_mask), self.sample_weights_single(w_b, "b", given_max_rank_id=dimension_mask)
-        )
-        sampled_bias = self.sample_bias(bias, given_max_rank_id=dimension_mask)
-        return sampled_w_a.cuda(), sampled_w_b.cuda(), sampled_bias.cuda()
-
-    def sample_bias(self, bias, given_max_rank_id=None):
-        ws = []
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            search_lora_dim = self.candidate_dims_binary
-            if given_max_rank_id is not None:
-                search_lora_dim[1] = self.candidate_dims[given_max_rank_id]
-        else:
-            search_lora_dim = self.candidate_dims
-
-        for sample_dim in search_lora_dim:
-            # Set non-sampled weights to zero
-            mask_weight = torch.zeros_like(bias)
-            mask_weight[:sample_dim] = 1
-            sampled_weight = mask_weight * bias
-            ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
-
-    def sample_weights_single(self, w, type="a", given_max_rank_id=None):
-        if w is None:
-            return None
-        ws = []
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            search_lora_dim = self.candidate_dims_binary
-            if given_max_rank_id is not None:
-                search_lora_dim[1] = self.candidate_dims[given_max_rank_id]
-        else:
-            search_lora_dim = self.candidate_dims
-
-        for sample_dim in search_lora_dim:
-            # Set non-sampled weights to zero
-            mask_weight = torch.zeros_like(w)
-            if type == "a":
-                mask_weight[:sample_dim, :] = 1
-            elif type == "b":
-                mask_weight[:, :sample_dim] = 1
-            sampled_weight = mask_weight * w
-            ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
-
 
 class PAdapterLayer(nn.Module):
     r"""A layer of adapter tuning module.
@@ -741,17 +919,6 @@ class PAdapterLayer(nn.Module):
             if module.bias is not None:
                 module.bias.data.zero_()
 
-    def sample_adapter(self, w_a, w_b, bias, gumbel_weights=None, dimension_mask=None):
-        stacked_samples = self.sample_weights(w_a, w_b, bias, dimension_mask=dimension_mask)
-        (sampled_w_a, sampled_w_b, sampled_bias) = stacked_samples
-        gumbel_weights = gumbel_weights.unsqueeze(-1).unsqueeze(-1)
-        # print(self.iterative_order, gumbel_weights, sampled_w_a,'jj')
-        w_a_sampled = torch.sum(gumbel_weights * sampled_w_a, dim=0)
-        w_b_sampled = torch.sum(gumbel_weights.detach() * sampled_w_b, dim=0)
-        bias_sampled = torch.sum(gumbel_weights.squeeze(-1) * sampled_bias, dim=0)
-
-        return w_a_sampled, w_b_sampled, bias_sampled
-
     def forward(self, output, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None, **kwargs):
         r""" Get the hidden_states from the PLM's layer output, pass it into the adapter,
         then combined with the main hidden_states. Finally pass it into the subsequent layer.
@@ -776,13 +943,10 @@ class PAdapterLayer(nn.Module):
             return x
 
         if gumbel_weights is not None:
-            # t1 = time.time()
-            w_a_sampled, w_b_sampled, bias_sampled = (
-                self.sample_adapter(self.down_proj.weight, self.up_proj.weight, bias=self.down_proj.bias, gumbel_weights=gumbel_weights,
-                                    dimension_mask=dimension_mask))
-            x = F.linear(hiddens, weight=w_a_sampled, bias=bias_sampled)
-            x = self.non_linear(x)
-            adapter_output = F.linear(x, weight=w_b_sampled, bias=self.up_proj.bias)
+            search_dims = get_search_dims(self.candidate_dims, self.candidate_dims_binary, iterative_order,
+                                          main_forward, given_max_rank_id=dimension_mask)
+            adapter_output = nested_bottleneck_forward(hiddens, self.down_proj, self.up_proj, self.non_linear,
+                                                       gumbel_weights, search_dims)
         elif self.fix_weight is not None:
             if self.binary_choice == 1:
                 w_a_sampled, w_b_sampled = self.down_proj.weight[:self.dim_choice, :], self.up_proj.weight[:,
@@ -800,55 +964,6 @@ class PAdapterLayer(nn.Module):
 
         return adapter_output
 
-    def sample_weights(self, w_a, w_b, bias, dimension_mask=None):
-        (sampled_w_a, sampled_w_b) = (
-            self.sample_weights_single(w_a, "a", given_max_rank_id=dimension_mask),
-            self.sample_weights_single(w_b, "b", given_max_rank_id=dimension_mask)
-        )
-        sampled_bias = self.sample_bias(bias, given_max_rank_id=dimension_mask)
-        return sampled_w_a.cuda(), sampled_w_b.cuda(), sampled_bias.cuda()
-
-    def sample_bias(self, bias, given_max_rank_id=None):
-        ws = []
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            search_lora_dim = self.candidate_dims_binary
-            if given_max_rank_id is not None:
-                search_lora_dim[1] = self.candidate_dims[given_max_rank_id]
-        else:
-            search_lora_dim = self.candidate_dims
-
-        for sample_dim in search_lora_dim:
-            # Set non-sampled weights to zero
-            mask_weight = torch.zeros_like(bias)
-            mask_weight[:sample_dim] = 1
-            sampled_weight = mask_weight * bias
-            ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
-
-    def sample_weights_single(self, w, type="a", given_max_rank_id=None):
-        if w is None:
-            return None
-        ws = []
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            search_lora_dim = self.candidate_dims_binary
-            if given_max_rank_id is not None:
-                search_lora_dim[1] = self.candidate_dims[given_max_rank_id]
-        else:
-            search_lora_dim = self.candidate_dims
-
-        for sample_dim in search_lora_dim:
-            # Set non-sampled weights to zero
-            mask_weight = torch.zeros_like(w)
-            if type == "a":
-                mask_weight[:sample_dim, :] = 1
-            elif type == "b":
-                mask_weight[:, :sample_dim] = 1
-            sampled_weight = mask_weight * w
-            ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
-
 
 class PrefixTuningSearch(nn.Module):
     def __init__(
@@ -873,6 +988,8 @@ class PrefixTuningSearch(nn.Module):
 
         self.candidate_dims = candidate_dims
         self.candidate_dims_binary = [0, prefix_length]
+        # candidate id -> prefix length lookup, kept on the module device
+        self.register_buffer("candidate_dims_tensor", torch.tensor(candidate_dims, dtype=torch.long), persistent=False)
         # self.prefix_control_trans = nn.Sequential(
         #     nn.Linear(self.input_size, 32),
         #     nn.ReLU(),
@@ -883,6 +1000,7 @@ class PrefixTuningSearch(nn.Module):
         self.binary_mask, self.dimension_mask = None, None
         self.retrain_flag = False
         self.subprefix_grad_dict = dict()
+        self.prefix_cache = PrefixKVCache()
         # self.prefix_module_list = nn.ModuleList()
 
     def init_prefix_up(self):
@@ -895,20 +1013,16 @@ class PrefixTuningSearch(nn.Module):
     def freeze_arch(self, finalized_weight, retrain_flag):
         self.binary_mask, dimension_mask = finalized_weight['binary'], finalized_weight['dim']
         if dimension_mask is not None:
-            dimension_mask = dimension_mask.tolist()
-            dimension_mask = [self.candidate_dims[int(i)] for i in dimension_mask]
-            dimension_mask = torch.tensor(dimension_mask)
+            dimension_mask = self.candidate_dims_tensor[dimension_mask.to(self.candidate_dims_tensor.device).long()]
         self.dimension_mask = dimension_mask
         self.retrain_flag = retrain_flag
+        self.prefix_cache.clear()
 
 
-    def eject(self, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None):
-        self.iterative_order = iterative_order
-        self.main_forward = main_forward
-
-        input_tokens = torch.arange(self.prefix_length).long().cuda()
-        # input_tokens = input_tokens.unsqueeze(0).expand(batch_size, -1)
-        embs = self.prefix_wte(input_tokens)
+    def key_values(self):
+        # unmasked prefix key/values of all layers, [layers, len(kv), prefix, dim]
+        # embedding of arange(prefix_length) is the whole embedding table
+        embs = self.prefix_wte.weight
         key_values = self.prefix_down(embs)
         key_values = F.relu(key_values)
         # key_values = self.prefix_up(key_values)
@@ -926,62 +1040,38 @@ class PrefixTuningSearch(nn.Module):
         key_values = key_values.view(
                 self.n_layers, 2, self.prefix_length, self.input_size
             )  # *2 for key and value
+        return key_values
 
-        if gumbel_weights is not None:
-            # print(gumbel_weights,'bwhe')
-            if dimension_mask is not None:
-                dimension_mask = dimension_mask.tolist()
-                dimension_mask = [self.candidate_dims[int(i)] for i in dimension_mask]
-                dimension_mask = torch.tensor(dimension_mask)
-            key_values = self.sample_prefix(key_values, gumbel_weights=gumbel_weights, dimension_mask=dimension_mask)
-        elif self.binary_mask is not None:
-            # print(self.dimension_mask, 'dniu')
+    def fixed_key_values(self):
+        # prefix under the finalized masks (if any); without autograd it is kept until a parameter changes
+        if torch.is_grad_enabled():
+            return self.masked_key_values()
+        return self.prefix_cache.get((param_versions(self), self.iterative_order, self.main_forward), self.masked_key_values)
 
+    def masked_key_values(self):
+        key_values = self.key_values()
+        if self.binary_mask is not None:
             key_values = self.sample_prefix(key_values, gumbel_weights=self.binary_mask, dimension_mask=self.dimension_mask)
+        return key_values
+
+    def eject(self, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None):
+        self.iterative_order = iterative_order
+        self.main_forward = main_forward
 
+        if gumbel_weights is None:
+            return self.fixed_key_values()
+        key_values = self.key_values()
+        if dimension_mask is not None:
+            dimension_mask = self.candidate_dims_tensor[dimension_mask.long()]
+        key_values = self.sample_prefix(key_values, gumbel_weights=gumbel_weights, dimension_mask=dimension_mask)
         return key_values
 
     def sample_prefix(self, prefix, gumbel_weights=None, dimension_mask=None):
-        # dimension_mask: shape [layers]
-        stacked_samples = self.sample_weights(prefix, dimension_mask=dimension_mask)
-        sampled_w = stacked_samples
-        #gumbel weights in shape [layers, candidates], sampled_w in shape [candidates, layers, len(qv), prefix, dim]
-        gumbel_weights = gumbel_weights.permute(1, 0).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
-        # print(self.iterative_order, gumbel_weights, sampled_w_a,'jj')
-        w_sampled = torch.sum(gumbel_weights * sampled_w, dim=0)
-
-        return w_sampled
-
-    def sample_weights(self, w_a, dimension_mask=None):
-        sampled_w_a = self.sample_weights_single(w_a, dimension_mask)
-        return sampled_w_a.cuda()
-
-    def sample_weights_single(self, w, dimension_mask):
-        if w is None:
-            return None
-        ws = []
-        length = self.prefix_length
-        dim = w.shape[-1]
-        layers = w.shape[0]
-        if dimension_mask is not None:  # here, adapt for the dimension mask in binary search stage
-            range_tensor = torch.arange(w.size(2))[None, None, :, None]  # shape [1, 1, length, 1]
-            range_tensor = range_tensor.expand(layers, 2, length, dim)  # Expand to match the shape of w
-            M_expanded = dimension_mask[:, None, None, None]  # shape [layers, 1, 1, 1]
-            M_expanded = M_expanded.expand(layers, 2, length, dim)  # Expand to match the shape of A
-            mask = range_tensor.cuda() < M_expanded.cuda()
-            w = w * mask.cuda()
-        if self.iterative_order is not None and (self.iterative_order or self.main_forward):
-            ws = [torch.zeros_like(w).cuda(), w]  # w will be dimension-masked if dimension mask is not None
-        else:
-            search_lora_dim = self.candidate_dims
-            for sample_dim in search_lora_dim:
-                # Set non-sampled weights to zero
-                mask_weight = torch.zeros_like(w).cuda()
-                mask_weight[:, :, :sample_dim, :] = 1
-                sampled_weight = mask_weight * w
-                ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
+        # prefix: [layers, len(kv), prefix, dim], gumbel weights: [layers, candidates], dimension_mask: [layers]
+        binary_stage = bool(self.iterative_order is not None and (self.iterative_order or self.main_forward))
+        keep = prefix_keep_weight(gumbel_weights, self.candidate_dims, self.prefix_length, binary_stage,
+                                  dimension_mask=dimension_mask)
+        return prefix * keep[:, None, :, None]
 
 
 
@@ -1028,6 +1118,7 @@ class PrefixTuning(nn.Module):
         self.binary_mask, self.dimension_mask = None, None
         self.retrain_flag = False
         self.subprefix_grad_dict = dict()
+        self.prefix_cache = PrefixKVCache()
 
     def upgrade_sub_grad(self):
         prefix_weight = self.prefix_up.grad.view(
@@ -1049,15 +1140,13 @@ class PrefixTuning(nn.Module):
     def freeze_arch(self, finalized_weight, retrain_flag):
         self.binary_mask, self.dimension_mask = finalized_weight['binary'], finalized_weight['dim']
         self.retrain_flag = retrain_flag
+        self.prefix_cache.clear()
 
 
-    def eject(self, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None):
-        self.iterative_order = iterative_order
-        self.main_forward = main_forward
-
-        input_tokens = torch.arange(self.prefix_length).long().cuda()
-        # input_tokens = input_tokens.unsqueeze(0).expand(batch_size, -1)
-        embs = self.prefix_wte(input_tokens)
+    def key_values(self):
+        # unmasked prefix key/values of all layers, [layers, len(kv), prefix, dim]
+        # embedding of arange(prefix_length) is the whole embedding table
+        embs = self.prefix_wte.weight
         key_values = self.prefix_down(embs)
         key_values = F.relu(key_values)
         key_values = self.prefix_up(key_values)
@@ -1069,55 +1158,36 @@ class PrefixTuning(nn.Module):
         key_values = key_values.view(
                 self.n_layers, 2, self.prefix_length, self.input_size
             )  # *2 for key and value
+        return key_values
 
-        if gumbel_weights is not None:
-            key_values = self.sample_prefix(key_values, gumbel_weights=gumbel_weights, dimension_mask=dimension_mask)
-        elif self.binary_mask is not None:
+    def fixed_key_values(self):
+        # prefix under the finalized masks (if any); without autograd it is kept until a parameter changes
+        if torch.is_grad_enabled():
+            return self.masked_key_values()
+        return self.prefix_cache.get((param_versions(self), self.iterative_order, self.main_forward), self.masked_key_values)
+
+    def masked_key_values(self):
+        key_values = self.key_values()
+        if self.binary_mask is not None:
             key_values = self.sample_prefix(key_values, gumbel_weights=self.binary_mask, dimension_mask=self.dimension_mask)
+        return key_values
 
+    def eject(self, gumbel_weights=None, dimension_mask=None, iterative_order=None, main_forward=None):
+        self.iterative_order = iterative_order
+        self.main_forward = main_forward
+
+        if gumbel_weights is None:
+            return self.fixed_key_values()
+        key_values = self.key_values()
+        key_values = self.sample_prefix(key_values, gumbel_weights=gumbel_weights, dimension_mask=dimension_mask)
         return key_values
 
     def sample_prefix(self, prefix, gumbel_weights=None, dimension_mask=None):
-        # dimension_mask: shape [layers]
-        stacked_samples = self.sample_weights(prefix, dimension_mask=dimension_mask)
-        sampled_w = stacked_samples
-        #gumbel weights in shape [layers, candidates], sampled_w in shape [candidates, layers, len(qv), prefix, dim]
-        gumbel_weights = gumbel_weights.permute(1, 0).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
-        # print(self.iterative_order, gumbel_weights, sampled_w_a,'jj')
-        w_sampled = torch.sum(gumbel_weights * sampled_w, dim=0)
-
-        return w_sampled
-
-    def sample_weights(self, w_a, dimension_mask=None):
-        sampled_w_a = self.sample_weights_single(w_a, dimension_mask)
-        return sampled_w_a.cuda()
-
-    def sample_weights_single(self, w, dimension_mask):
-        if w is None:
-            return None
-        ws = []
-        length = self.prefix_length
-        dim = w.shape[-1]
-        layers = w.shape[0]
-        if dimension_mask is not None:  # here, adapt for the dimension mask in binary search stage
-            range_tensor = torch.arange(w.size(2))[None, None, :, None]  # shape [1, 1, length, 1]
-            range_tensor = range_tensor.expand(layers, 2, length, dim)  # Expand to match the shape of w
-            M_expanded = dimension_mask[:, None, None, None]  # shape [layers, 1, 1, 1]
-            M_expanded = M_expanded.expand(layers, 2, length, dim)  # Expand to match the shape of A
-            mask = range_tensor.cuda() < M_expanded.cuda()
-            w = w * mask.cuda()
-        if (self.iterative_order is not None and self.iterative_order) or self.main_forward:
-            ws = [torch.zeros_like(w).cuda(), w]  # w will be dimension-masked if dimension mask is not None
-        else:
-            search_lora_dim = self.candidate_dims
-            for sample_dim in search_lora_dim:
-                # Set non-sampled weights to zero
-                mask_weight = torch.zeros_like(w).cuda()
-                mask_weight[:, :, :sample_dim, :] = 1
-                sampled_weight = mask_weight * w
-                ws.append(sampled_weight)
-
-        return torch.stack(ws, dim=0)
+        # prefix: [layers, len(kv), prefix, dim], gumbel weights: [layers, candidates], dimension_mask: [layers]
+        binary_stage = bool((self.iterative_order is not None and self.iterative_order) or self.main_forward)
+        keep = prefix_keep_weight(gumbel_weights, self.candidate_dims, self.prefix_length, binary_stage,
+                                  dimension_mask=dimension_mask)
+        return prefix * keep[:, None, :, None]
 
 
 
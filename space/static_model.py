@@ -0,0 +1,150 @@
+import torch
+import torch.nn as nn
+
+from space.peft_modules import Mix_PEFT, LoRA_ParallelLayer, PrefixKVCache, param_versions
+from space.forward_injection import reset_forward
+from space.t5_forward_mom import static_attn_forward
+
+
+def branch_kept(module):
+    # a finalized branch that changes the output; a LoRA of rank 0 adds zeros
+    if not Mix_PEFT.branch_selected(module):
+        return False
+    if isinstance(module, LoRA_ParallelLayer):
+        return hasattr(module, 'LoRA_a') and getattr(module, 'dim_choice', 1) != 0
+    return True
+
+
+def add_to_output(hidden_flow, out):
+    if isinstance(hidden_flow, tuple):
+        return (hidden_flow[0] + out,) + hidden_flow[1:]
+    return hidden_flow + out
+
+
+class StaticPEFT(nn.Module):
+    """
+    Finalized Mix_PEFT: the wrapped module plus the selected branches only, without gumbel/plan/sparse
+    bookkeeping. Attribute names follow Mix_PEFT and a shell without selected branches stays as a pass-through,
+    so every parameter keeps its MoM_T5 name (...SelfAttention.original_module.q.lora.LoRA_a.weight).
+    """
+    def __init__(self, shell: Mix_PEFT):
+        super().__init__()
+        self.original_module = shell.original_module
+        self.lora, self.bitfit, self.lnfit, self.adapter, self.sadapter, self.padapter = \
+            [module if branch_kept(module) else None
+             for module in [shell.lora, shell.bitfit, shell.lnfit, shell.adapter, shell.sadapter, shell.padapter]]
+        if shell.merged:
+            # LoRA/LNfit live in the wrapped weights now, BitFit too unless it follows a layer norm
+            self.lora, self.lnfit = None, None
+            if shell.merged_bias is None:
+                self.bitfit = None
+        self.fuse_norm = shell.fuse_norm and self.lnfit is not None
+
+    @property
+    def weight(self):
+        # T5DenseActDense reads self.wo.weight.dtype
+        return self.original_module.weight
+
+    def forward(self, x, *args, **kwargs):
+        if self.fuse_norm:
+            norm = self.original_module
+            hidden_flow = (norm.weight + self.lnfit.scaled_weight()) * \
+                          self.lnfit.normalize(x, eps=norm.variance_epsilon, dtype=norm.weight.dtype)
+            if self.bitfit is not None:
+                hidden_flow = hidden_flow + self.bitfit(hidden_flow)
+            return hidden_flow
+
+        hidden_flow = self.original_module(x, *args, **kwargs)
+        if self.lora is not None:
+            hidden_flow = hidden_flow + self.lora(x)
+        if self.lnfit is not None:
+            hidden_flow = hidden_flow + self.lnfit(x)
+        if self.bitfit is not None:
+            hidden_flow = hidden_flow + self.bitfit(hidden_flow)
+        if self.adapter is not None:
+            hidden_flow = add_to_output(hidden_flow, self.adapter(hidden_flow))
+        if self.sadapter is not None:
+            hiddens = hidden_flow[0] if isinstance(hidden_flow, tuple) else hidden_flow
+            sa_output = self.sadapter(hiddens)
+            if self.padapter is None:
+                hidden_flow = add_to_output(hidden_flow, sa_output)
+        if self.padapter is not None:
+            # PA reads the module input; with SA both are added to the module output
+            pa_output = self.padapter(x)
+            if self.sadapter is not None:
+                pa_output = pa_output + sa_output
+            hidden_flow = add_to_output(hidden_flow, pa_output)
+        return hidden_flow
+
+
+class StaticT5(nn.Module):
+    """
+    The finalized T5 of a MoM_T5 as a plain module tree: Mix_PEFT shells are replaced by StaticPEFT, the
+    transformers forwards are restored, and the prefix (if any) is ejected once per stack call by a pre-hook
+    and read by static_attn_forward. The (frozen) arch weights are kept under their MoM_T5 names, so a
+    checkpoint of the static model holds the same keys as one of MoM_T5 and loads into either.
+    """
+    def __init__(self, t5_model, prefix_keep=None, arch_parameters=None):
+        super().__init__()
+        self.t5_model = t5_model
+        for name, param in (arch_parameters or dict()).items():
+            param.requires_grad = False
+            self.register_parameter(name, param)
+        self.early_stop = False
+        self.register_buffer('prefix_keep', prefix_keep, persistent=False)
+        self.hooks = []
+        self.prefix_cache = PrefixKVCache()
+        if hasattr(t5_model, 'prefix_module'):
+            for blk in list(t5_model.encoder.block) + list(t5_model.decoder.block):
+                attn = blk.layer[0].SelfAttention.original_module
+                attn.forward = static_attn_forward.__get__(attn, attn.__class__)
+            self.num_encoder_layers = len(t5_model.encoder.block)
+            self.hooks = [t5_model.encoder.register_forward_pre_hook(self.set_prefix),
+                          t5_model.decoder.register_forward_pre_hook(self.set_prefix)]
+
+    def prefix(self):
+        if torch.is_grad_enabled():
+            return self.masked_prefix()
+        return self.prefix_cache.get(param_versions(self.t5_model.prefix_module), self.masked_prefix)
+
+    def masked_prefix(self):
+        key_values = self.t5_model.prefix_module.key_values()  # [layers, len(kv), prefix, dim]
+        if self.prefix_keep is not None:
+            key_values = key_values * self.prefix_keep[:, None, :, None]
+        return key_values
+
+    def set_prefix(self, stack, inputs):
+        key_values = self.prefix()
+        start = 0 if stack is self.t5_model.encoder else self.num_encoder_layers
+        for i, blk in enumerate(stack.block):
+            attn = blk.layer[0].SelfAttention.original_module
+            attn.static_prefix = key_values[start + i]
+
+    def forward(self, x, cur_epoch=None, eval_mode=False, main_forward=False):
+        return self.t5_model(**x)
+
+
+@torch.no_grad()
+def build_static_model(arch, merge=False):
+    """
+    arch: a MoM_T5 after finalize_arch(). Returns a StaticT5 sharing its parameters and (frozen) arch weights;
+    the search bookkeeping is left behind. merge=True first folds LoRA/BitFit/LNfit into the frozen weights
+    where the shell allows it (inference only, the folded deltas are no longer trainable).
+    """
+    t5_model = arch.t5_model
+    for parent, attr, shell in arch._peft_shells():
+        if merge and not shell.merged and shell.mergeable():
+            shell.merge()
+        setattr(parent, attr, StaticPEFT(shell))
+    reset_forward(t5_model)
+
+    prefix_keep = None
+    prefix_module = getattr(t5_model, 'prefix_module', None)
+    if prefix_module is not None and prefix_module.binary_mask is not None:
+        # the keep weight eject() applies in the finalized forward (iterative_order=None, main_forward=True)
+        prefix_module.iterative_order, prefix_module.main_forward = None, True
+        ones = torch.ones(prefix_module.n_layers, 1, prefix_module.prefix_length, 1, device=prefix_module.prefix_wte.weight.device)
+        prefix_keep = prefix_module.sample_prefix(ones, gumbel_weights=prefix_module.binary_mask,
+                                                  dimension_mask=prefix_module.dimension_mask)[:, 0, :, 0]
+    arch_parameters = {name: param for name, param in arch.named_parameters(recurse=False) if 'arch' in name}
+    return StaticT5(t5_model, prefix_keep=prefix_keep, arch_parameters=arch_parameters)
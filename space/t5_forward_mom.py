@@ -6,6 +6,7 @@ from torch.utils.checkpoint import checkpoint
 from transformers.utils import logging
 
 from torch.nn import CrossEntropyLoss
+from space.peft_modules import grouped_lora_forward, param_versions, PrefixKVCache
 from transformers.modeling_outputs import (
     BaseModelOutput,
     BaseModelOutputWithPastAndCrossAttentions,
@@ -96,12 +97,15 @@ Examples::
             dimension_mask_prefix = dimension_mask['prefix_dimension_mask']
         prefix = self.prefix_module.eject(gumbel_prefix, dimension_mask=dimension_mask_prefix, iterative_order=iterative_order, main_forward=main_forward)
         # print("prefix 1", prefix.size())
-        encoder_prefix, decoder_prefix = prefix[:24], prefix[24:]
+        num_encoder_layers = len(self.encoder.block)
+        encoder_prefix, decoder_prefix = prefix[:num_encoder_layers], prefix[num_encoder_layers:]
 
     encoder_gumbel_weights, decoder_gumbel_weights, final_norm_gumbel_weights = None, None, None
     encoder_dimension_mask, decoder_dimension_mask = None, None
     # print("gumbel weights in fors", gumbel_weights)
-    if gumbel_weights is not None:
+    # with an active dispatch plan the wrapped modules read their weights by slot, nothing is sliced here
+    dispatch_plan = getattr(self, "dispatch_plan", None)
+    if gumbel_weights is not None and (dispatch_plan is None or not dispatch_plan.active):
         # encoder_layers = len(self.encoder.block)
 
         encoder_gumbel_weights = {
@@ -483,6 +487,14 @@ def stack_forward(
         cross_attentions=all_cross_attentions,
     )
 
+def clamp_fp16_inf(hidden_states):
+    # the fp16 inf clamp of transformers without the host sync of .any(), so a compiled block has no graph break
+    if hidden_states.dtype != torch.float16:
+        return hidden_states
+    clamp_value = torch.finfo(torch.float16).max - 1000 * torch.isinf(hidden_states).any().to(hidden_states.dtype)
+    return torch.maximum(torch.minimum(hidden_states, clamp_value), -clamp_value)
+
+
 def block_forward(
         self,
         hidden_states,
@@ -588,9 +600,7 @@ def block_forward(
     attention_outputs = self_attention_outputs[2:]  # Keep self-attention outputs and relative position weights
 
     # clamp inf values to enable fp16 training
-    if hidden_states.dtype == torch.float16 and torch.isinf(hidden_states).any():
-        clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-        hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+    hidden_states = clamp_fp16_inf(hidden_states)
 
     do_cross_attention = self.is_decoder and encoder_hidden_states is not None
     if do_cross_attention:
@@ -616,9 +626,7 @@ def block_forward(
         hidden_states = cross_attention_outputs[0]
 
         # clamp inf values to enable fp16 training
-        if hidden_states.dtype == torch.float16 and torch.isinf(hidden_states).any():
-            clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-            hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+        hidden_states = clamp_fp16_inf(hidden_states)
 
         # Combine self attn and cross attn key value states
         if present_key_value_state is not None:
@@ -636,9 +644,7 @@ def block_forward(
                                    iterative_order=iterative_order, main_forward=main_forward)
 
     # clamp inf values to enable fp16 training
-    if hidden_states.dtype == torch.float16 and torch.isinf(hidden_states).any():
-        clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-        hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+    hidden_states = clamp_fp16_inf(hidden_states)
 
     outputs = (hidden_states,)
 
@@ -805,12 +811,12 @@ def attn_forward(
         """reshape"""
         return states.transpose(1, 2).contiguous().view(batch_size, -1, self.inner_dim)
 
-    def project(hidden_states, proj_layer, key_value_states, past_key_value, gumbel_weight=None, dimension_mask=None):
+    def project(hidden_states, proj_layer, key_value_states, past_key_value, gumbel_weight=None, dimension_mask=None, lora_output=None):
         """projects hidden states correctly to key/query states"""
         if key_value_states is None:
             # self-attn
             # (batch_size, n_heads, seq_length, dim_per_head)
-            hidden_states = shape(proj_layer(hidden_states, gumbel_weight, dimension_mask=dimension_mask, iterative_order=iterative_order, main_forward=main_forward))
+            hidden_states = shape(proj_layer(hidden_states, gumbel_weight, dimension_mask=dimension_mask, iterative_order=iterative_order, main_forward=main_forward, lora_output=lora_output))
         elif past_key_value is None:
             # cross-attn
             # (batch_size, n_heads, seq_length, dim_per_head)
@@ -826,21 +832,40 @@ def attn_forward(
                 hidden_states = past_key_value
         return hidden_states
 
+    # grouped q/k/v LoRA: one down projection and one batched up projection on the shared input
+    lora_q, lora_k, lora_v = None, None, None
+    if key_value_states is None and getattr(self, "group_qkv_lora", False) \
+            and not any('lora' in proj.skip_branches for proj in (self.q, self.k, self.v)):
+        lora_gumbel, lora_mask = [gumbel_q, gumbel_k, gumbel_v], [mask_q, mask_k, mask_v]
+        if gumbel_weight_layer is None and self.q.plan_active:
+            lora_gumbel, lora_mask = map(list, zip(*[proj.planned_branch('lora') for proj in (self.q, self.k, self.v)]))
+        if lora_gumbel[0] is not None:
+            lora_q, lora_k, lora_v = grouped_lora_forward([self.q.lora, self.k.lora, self.v.lora], hidden_states,
+                                                          lora_gumbel, lora_mask,
+                                                          iterative_order=iterative_order, main_forward=main_forward)
+
     # get query states
-    mask_q_dict = {"lora":mask_q, "adapter":None}
-    gumbel_q_dict = {"lora":gumbel_q, "adapter":None, "bitfit":gumbel_q_bias, "lnfit":None}
+    mask_q_dict, gumbel_q_dict, mask_k_dict, gumbel_k_dict, mask_v_dict, gumbel_v_dict, mask_o_dict, gumbel_o_dict = [None] * 8
+    if gumbel_weight_layer is not None:
+        mask_q_dict = {"lora":mask_q, "adapter":None}
+        gumbel_q_dict = {"lora":gumbel_q, "adapter":None, "bitfit":gumbel_q_bias, "lnfit":None}
     query_states = shape(self.q(hidden_states, gumbel_weights=gumbel_q_dict, dimension_mask=mask_q_dict,
-                                iterative_order=iterative_order, main_forward=main_forward))  # (batch_size, n_heads, seq_length, dim_per_head)
+                                iterative_order=iterative_order, main_forward=main_forward, lora_output=lora_q))  # (batch_size, n_heads, seq_length, dim_per_head)
 
     # get key/value states
-    mask_k_dict = {"lora": mask_k, "adapter": None}
-    gumbel_k_dict = {"lora": gumbel_k, "adapter": None, "bitfit": gumbel_k_bias, "lnfit": None}
-    mask_v_dict = {"lora": mask_v, "adapter": None}
-    gumbel_v_dict = {"lora": gumbel_v, "adapter": None, "bitfit": gumbel_v_bias, "lnfit": None}
+    if gumbel_weight_layer is not None:
+        mask_k_dict = {"lora": mask_k, "adapter": None}
+        gumbel_k_dict = {"lora": gumbel_k, "adapter": None, "bitfit": gumbel_k_bias, "lnfit": None}
+        mask_v_dict = {"lora": mask_v, "adapter": None}
+        gumbel_v_dict = {"lora": gumbel_v, "adapter": None, "bitfit": gumbel_v_bias, "lnfit": None}
     
     key_hidden, value_hidden = hidden_states, hidden_states
     prefix_length = 0
-    if prefix is not None:
+    if prefix is not None and gumbel_weight_layer is None and not torch.is_grad_enabled() \
+            and not getattr(self.k, "plan_active", False):
+        prefix_key_states, prefix_value_states = cached_prefix_states(
+            self, prefix, batch_size, past_key_value, iterative_order=iterative_order, main_forward=main_forward)
+    elif prefix is not None:
 
         # print("prefix is not None:", prefix.size())
         batch_size = hidden_states.shape[0]
@@ -864,22 +889,26 @@ def attn_forward(
 
     key_states = project(
         hidden_states, self.k, key_value_states, past_key_value[0] if past_key_value is not None else None,
-        gumbel_weight=gumbel_k_dict, dimension_mask=mask_k_dict
+        gumbel_weight=gumbel_k_dict, dimension_mask=mask_k_dict, lora_output=lora_k
     )
     value_states = project(
         hidden_states, self.v, key_value_states, past_key_value[1] if past_key_value is not None else None,
-        gumbel_weight=gumbel_v_dict, dimension_mask=mask_v_dict
+        gumbel_weight=gumbel_v_dict, dimension_mask=mask_v_dict, lora_output=lora_v
     )
 
+    # scaled_dot_product_attention needs neither the weights nor the head mask
+    use_sdpa = getattr(self, "attn_backend", "eager") == "sdpa" and not output_attentions and layer_head_mask is None
+
     # compute scores
-    scores = torch.matmul(
-        query_states, key_states.transpose(3, 2)
-    )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
+    if not use_sdpa:
+        scores = torch.matmul(
+            query_states, key_states.transpose(3, 2)
+        )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
     # print("sc is not None:", scores.size())
     if position_bias is None:
         if not self.has_relative_attention_bias:
             position_bias = torch.zeros(
-                (1, self.n_heads, real_seq_length, key_length), device=scores.device, dtype=scores.dtype
+                (1, self.n_heads, real_seq_length, key_length), device=query_states.device, dtype=query_states.dtype
             )
             if self.training and self.gradient_checkpointing:
                 position_bias.requires_grad = True
@@ -893,36 +922,45 @@ def attn_forward(
 
         if mask is not None:
             position_bias = position_bias + mask  # (batch_size, n_heads, seq_length, key_length)
-    # print(scores.size(), "score")
-    # print(position_bias.size(), "position_bias")
-    if prefix is not None:
-        prefix_scores = torch.matmul(query_states, prefix_key_states.transpose(3, 2))
-
-    scores += position_bias
-    if prefix is not None:
-        # Apply gating to the prefix attention scores
-        # print(prefix_scores.size(), "cje")
-        # print(scores.size(), "cje")
-        prefix_attn_weights = self.prefix_gate * nn.functional.softmax(prefix_scores.float(), dim=-1).type_as(
+
+    if use_sdpa:
+        attn_output = unshape(sdpa_attention(query_states, key_states, value_states, position_bias,
+                                             dropout=self.dropout if self.training else 0.0))
+        if prefix is not None:
+            # the gate is constant over the prefix positions, so it scales the attended prefix values
+            attn_output = attn_output + unshape(self.prefix_gate * sdpa_attention(query_states, prefix_key_states, prefix_value_states))
+    else:
+        # print(scores.size(), "score")
+        # print(position_bias.size(), "position_bias")
+        if prefix is not None:
+            prefix_scores = torch.matmul(query_states, prefix_key_states.transpose(3, 2))
+
+        scores += position_bias
+        if prefix is not None:
+            # Apply gating to the prefix attention scores
+            # print(prefix_scores.size(), "cje")
+            # print(scores.size(), "cje")
+            prefix_attn_weights = self.prefix_gate * nn.functional.softmax(prefix_scores.float(), dim=-1).type_as(
+                scores
+            )
+            prefix_output = unshape(torch.matmul(prefix_attn_weights, prefix_value_states))  # (batch_size, seq_length, dim)
+
+        attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(
             scores
-        )
-        prefix_output = unshape(torch.matmul(prefix_attn_weights, prefix_value_states))  # (batch_size, seq_length, dim)
-
-    attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(
-        scores
-    )  # (batch_size, n_heads, seq_length, key_length)
-    attn_weights = nn.functional.dropout(
-        attn_weights, p=self.dropout, training=self.training
-    )  # (batch_size, n_heads, seq_length, key_length)
-
-    # Mask heads if we want to
-    if layer_head_mask is not None:
-        attn_weights = attn_weights * layer_head_mask
-    attn_output = unshape(torch.matmul(attn_weights, value_states))  # (batch_size, seq_length, dim)
-    if prefix is not None:
-        attn_output = attn_output + prefix_output
-    mask_o_dict = {"lora": mask_o, "adapter": None}
-    gumbel_o_dict = {"lora": gumbel_o, "adapter": None, "bitfit": gumbel_o_bias, "lnfit": None}
+        )  # (batch_size, n_heads, seq_length, key_length)
+        attn_weights = nn.functional.dropout(
+            attn_weights, p=self.dropout, training=self.training
+        )  # (batch_size, n_heads, seq_length, key_length)
+
+        # Mask heads if we want to
+        if layer_head_mask is not None:
+            attn_weights = attn_weights * layer_head_mask
+        attn_output = unshape(torch.matmul(attn_weights, value_states))  # (batch_size, seq_length, dim)
+        if prefix is not None:
+            attn_output = attn_output + prefix_output
+    if gumbel_weight_layer is not None:
+        mask_o_dict = {"lora": mask_o, "adapter": None}
+        gumbel_o_dict = {"lora": gumbel_o, "adapter": None, "bitfit": gumbel_o_bias, "lnfit": None}
     attn_output = self.o(attn_output, gumbel_o_dict, dimension_mask=mask_o_dict, iterative_order=iterative_order, main_forward=main_forward)
 
     present_key_value_state = (key_states, value_states) if (self.is_decoder and use_cache) else None
@@ -934,6 +972,154 @@ def attn_forward(
 
 
 
+# the scale argument of scaled_dot_product_attention exists from torch 2.1
+_SDPA_SCALE = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+
+
+def sdpa_attention(query_states, key_states, value_states, bias=None, dropout=0.0):
+    """
+    T5 attention (no 1/sqrt(d) scaling, relative position bias + mask added to the scores) through the fused
+    scaled_dot_product_attention kernels, the [b, h, q, k] scores are not materialized.
+    """
+    if bias is not None:
+        bias = bias.to(query_states.dtype)
+    if _SDPA_SCALE:
+        return F.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=bias,
+                                              dropout_p=dropout, scale=1.0)
+    # older torch always scales by 1/sqrt(d), undo it on the query
+    query_states = query_states * query_states.shape[-1] ** 0.5
+    return F.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=bias, dropout_p=dropout)
+
+
+def cached_prefix_states(self, prefix, batch_size, past_key_value=None, **proj_kwargs):
+    """
+    Prefix keys/values of a self-attention layer projected by its (frozen) k/v once, [1, n_heads, prefix, dim_per_head],
+    and reused by every later call (each generate step) until the prefix or the k/v parameters change.
+    Expanded to the batch and, as in attn_forward, concatenated after the past states.
+    """
+    def compute():
+        states = [proj(p, **proj_kwargs).view(1, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
+                  for proj, p in ((self.k, prefix[0]), (self.v, prefix[1]))]
+        # the prefix is kept alive with the states, so its data_ptr identifies it
+        return prefix, states[0], states[1]
+
+    if not hasattr(self, "prefix_kv_cache"):
+        self.prefix_kv_cache = PrefixKVCache()
+    key = (prefix.data_ptr(), prefix._version, tuple(prefix.shape), param_versions(self.k, self.v))
+    _, prefix_key_states, prefix_value_states = self.prefix_kv_cache.get(key, compute)
+    prefix_key_states = prefix_key_states.expand(batch_size, -1, -1, -1)
+    prefix_value_states = prefix_value_states.expand(batch_size, -1, -1, -1)
+    if past_key_value is not None:
+        prefix_key_states = torch.cat([past_key_value[0], prefix_key_states], dim=2)
+        prefix_value_states = torch.cat([past_key_value[1], prefix_value_states], dim=2)
+    return prefix_key_states, prefix_value_states
+
+
+def clear_prefix_cache(model):
+    # after freeze_arch the k/v branches change without touching their parameters
+    for module in model.modules():
+        if hasattr(module, "prefix_kv_cache"):
+            module.prefix_kv_cache.clear()
+
+
+def static_attn_forward(
+        self,
+        hidden_states,
+        mask=None,
+        key_value_states=None,
+        position_bias=None,
+        past_key_value=None,
+        layer_head_mask=None,
+        query_length=None,
+        use_cache=False,
+        output_attentions=False,
+    ):
+    """
+    attn_forward of a finalized model: q/k/v/o are plain (static) modules and the prefix key/values of the
+    layer are read from self.static_prefix ([2, prefix_length, dim] or per row [batch, 2, prefix_length, dim],
+    set before the stack runs).
+    """
+    batch_size, seq_length = hidden_states.shape[:2]
+    real_seq_length = seq_length
+    if past_key_value is not None:
+        real_seq_length += past_key_value[0].shape[2] if query_length is None else query_length
+    key_length = real_seq_length if key_value_states is None else key_value_states.shape[1]
+
+    def shape(states):
+        return states.view(batch_size, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
+
+    def unshape(states):
+        return states.transpose(1, 2).contiguous().view(batch_size, -1, self.inner_dim)
+
+    def project(hidden_states, proj_layer, key_value_states, past_key_value):
+        if key_value_states is None:
+            hidden_states = shape(proj_layer(hidden_states))
+        elif past_key_value is None:
+            hidden_states = shape(proj_layer(key_value_states))
+        if past_key_value is not None:
+            if key_value_states is None:
+                hidden_states = torch.cat([past_key_value, hidden_states], dim=2)
+            else:
+                hidden_states = past_key_value
+        return hidden_states
+
+    query_states = shape(self.q(hidden_states))
+    key_states = project(hidden_states, self.k, key_value_states, past_key_value[0] if past_key_value is not None else None)
+    value_states = project(hidden_states, self.v, key_value_states, past_key_value[1] if past_key_value is not None else None)
+
+    prefix = getattr(self, "static_prefix", None)
+    if prefix is not None and prefix.dim() == 3 and not torch.is_grad_enabled():
+        prefix_key_states, prefix_value_states = cached_prefix_states(self, prefix, batch_size, past_key_value)
+    elif prefix is not None:
+        # same projection as attn_forward (past states included); a [batch, 2, prefix, dim] prefix is per row
+        prefix_key, prefix_value = (prefix[:, 0], prefix[:, 1]) if prefix.dim() == 4 else \
+            (prefix[0].unsqueeze(0).expand(batch_size, -1, -1), prefix[1].unsqueeze(0).expand(batch_size, -1, -1))
+        prefix_key_states = project(prefix_key, self.k, key_value_states,
+                                    past_key_value[0] if past_key_value is not None else None)
+        prefix_value_states = project(prefix_value, self.v, key_value_states,
+                                      past_key_value[1] if past_key_value is not None else None)
+
+    if position_bias is None:
+        if not self.has_relative_attention_bias:
+            position_bias = torch.zeros(
+                (1, self.n_heads, real_seq_length, key_length), device=query_states.device, dtype=query_states.dtype
+            )
+            if self.training and self.gradient_checkpointing:
+                position_bias.requires_grad = True
+        else:
+            position_bias = self.compute_bias(real_seq_length, key_length)
+        if past_key_value is not None:
+            position_bias = position_bias[:, :, -hidden_states.size(1):, :]
+        if mask is not None:
+            position_bias = position_bias + mask
+
+    if getattr(self, "attn_backend", "eager") == "sdpa" and not output_attentions and layer_head_mask is None:
+        attn_output = unshape(sdpa_attention(query_states, key_states, value_states, position_bias,
+                                             dropout=self.dropout if self.training else 0.0))
+        if prefix is not None:
+            attn_output = attn_output + unshape(self.prefix_gate * sdpa_attention(query_states, prefix_key_states, prefix_value_states))
+    else:
+        scores = torch.matmul(query_states, key_states.transpose(3, 2)) + position_bias
+        attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
+        attn_weights = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+        if layer_head_mask is not None:
+            attn_weights = attn_weights * layer_head_mask
+        attn_output = unshape(torch.matmul(attn_weights, value_states))
+
+        if prefix is not None:
+            prefix_scores = torch.matmul(query_states, prefix_key_states.transpose(3, 2))
+            prefix_attn_weights = self.prefix_gate * nn.functional.softmax(prefix_scores.float(), dim=-1).type_as(scores)
+            attn_output = attn_output + unshape(torch.matmul(prefix_attn_weights, prefix_value_states))
+    attn_output = self.o(attn_output)
+
+    present_key_value_state = (key_states, value_states) if (self.is_decoder and use_cache) else None
+    outputs = (attn_output,) + (present_key_value_state,) + (position_bias,)
+    if output_attentions:
+        outputs = outputs + (attn_weights,)
+    return outputs
+
+
+
 __HEAD_MASK_WARNING_MSG = """
 The input argument `head_mask` was split into two arguments `head_mask` and `decoder_head_mask`. Currently,
 `decoder_head_mask` is set to copy `head_mask`, but this feature is deprecated and will be removed in future versions.
@@ -10,12 +10,17 @@ import numpy as np
 from torch.distributions import dirichlet
 
 from transformers.models.t5.modeling_t5 import T5Config, T5ForConditionalGeneration
-from gumbel_module import GumbleSoftmax, gumbel_sample_weight, measure_entropy, calculate_zeta_for_shifting, bernoulli_sample
-from space.peft_modules import LoRA_PEFT, Mix_PEFT, PrefixTuning, PrefixTuningSearch
-from space.forward_injection import set_lora_forward
+from gumbel_module import GumbleSoftmax, gumbel_sample_weight, bernoulli_sample
+from space.peft_modules import Mix_PEFT, PrefixTuning, PrefixTuningSearch, PEFTDispatchPlan
+from space.peft_layers import quantize_linears
+from space.forward_injection import set_lora_forward, reset_forward
+from space.t5_forward_mom import clear_prefix_cache
 
 from utils.utils import cosine_similarity, recognize_layer_id, recognize_module_weights_loc, calculate_DSI, get_top_k_modules
 
+# Mersenne prime of the count-sketch hash; its coefficients and the element positions stay below 2**31, so
+# the int64 products never overflow
+SKETCH_HASH_PRIME = 2 ** 31 - 1
 
 
 def weights(model: nn.Module):
@@ -92,6 +97,10 @@ class MoM_T5(nn.Module):
             set_lora_forward(backbone)
 
         self._init_arch_weight()
+        if args.int8_backbone != 'none':
+            # frozen q/k/v/o/wi/wo (self and cross attention) in int8, the PEFT branches stay in full precision
+            quantize_linears(backbone.encoder, mode=args.int8_backbone)
+            quantize_linears(backbone.decoder, mode=args.int8_backbone)
         self._insert_peft_modules(backbone=backbone, r=r)
 
         if self.use_search:
@@ -153,19 +162,13 @@ class MoM_T5(nn.Module):
                 + self.arch_weights_binary_decoder.shape[0] * self.arch_weights_binary_decoder.shape[1]
                 + self.arch_weights_binary_final_norm.shape[0])
         # gradient storage, the sensitivity should >= 0
-        self.accumulated_gradient_matrix = [torch.tensor(0, dtype=torch.float).cuda() for _ in
+        self.accumulated_gradient_matrix = [torch.tensor(0, dtype=torch.float) for _ in
                                             range(num_matrix_modules)]
-        self.accumulated_gradient_vector = [torch.tensor(0, dtype=torch.float).cuda() for _ in
+        self.accumulated_gradient_vector = [torch.tensor(0, dtype=torch.float) for _ in
                                             range(num_vector_modules)]
         self.PEFT_pruning_flag_matrix = [False for _ in range(num_matrix_modules)]  # matrix based modules
         self.PEFT_pruning_flag_vector = [False for _ in range(num_vector_modules)]  # vector (bias) based modules
         self.prune_dict = dict()
-        self.gradient_records_dict = dict()
-        self.val_gradient_records_dict = dict()
-        self.train_gradient_records_dict = dict()
-        self.sen_records_dict = dict()  # sensitivity records
-        self.exp_avg_grad_records_dict = dict()
-        self.exp_avg_unc_records_dict = dict()
         self.param_scale_dict = dict()
         self.module_id_dict = dict()
         self.id_module_dict = dict()
@@ -176,19 +179,13 @@ class MoM_T5(nn.Module):
         self.vector_based_params_mapped_decoder = [0] * self.arch_weights_binary_decoder.shape[1]
         self.vector_based_params_mapped_final_norm = [0] * self.arch_weights_binary_final_norm.shape[0]
         if self.use_prefix:
-            self.prefix_params_mapped = [2 * 1024 * 2] * self.arch_weights_binary_prefix.shape[0]
+            self.prefix_params_mapped = [2 * self.t5_model.config.d_model * 2] * self.arch_weights_binary_prefix.shape[0]
 
         for name, param in self.t5_model.named_parameters():
             if param.requires_grad:
-                sub_ = name.split(".")
                 if 'gate' in name:
                     continue
-                if 'Adapter' in sub_[-2] or 'LoRA' in sub_[-2]:
-                    name = '.'.join(sub_[:-2])
-                elif 'prefix' in sub_[-2] and 'up' in sub_[-2] and 'gate' not in name:
-                    name = '.'.join(sub_[:-1])
-                elif 'sadapter' in sub_[-3] or 'padapter' in sub_[-3]:
-                    name = '.'.join(sub_[:-2])
+                name = self.sensitivity_module_name(name)
                 self.prune_dict[name] = False
                 if self.param_scale_dict.__contains__(name):
                     self.param_scale_dict[name] += param.numel()  # simply contains all parameters
@@ -197,17 +194,13 @@ class MoM_T5(nn.Module):
                     self.id_module_dict[module_id] = name
                     module_id += 1
                     self.param_scale_dict[name] = param.numel()
-                self.gradient_records_dict[name] = torch.tensor(0, dtype=torch.float).cuda()
-                self.val_gradient_records_dict[name] = []
-                self.train_gradient_records_dict[name] = []
-                self.sen_records_dict[name] = torch.tensor(0, dtype=torch.float).cuda()
-                self.exp_avg_grad_records_dict[name] = torch.tensor(0, dtype=torch.float).cuda()
-                self.exp_avg_unc_records_dict[name] = torch.tensor(0, dtype=torch.float).cuda()
         self.modules_number = module_id
         print(self.param_scale_dict)
         self.param_scale_list = [0] * self.modules_number
-        self.gradient_records_list = [None] * self.modules_number
+        self.gradient_records_list = None  # [modules] sensitivity, set by the first update_grad
         self.prune_records_list = [False] * self.modules_number
+        self.pruned_modules = torch.zeros(self.modules_number, dtype=torch.bool)
+        self.param_module_index = None  # sensitivity index, built on the first update_grad
         for (n, s) in self.param_scale_dict.items():
             module_id = self.module_id_dict[n]
             self.param_scale_list[module_id] = s
@@ -321,7 +314,7 @@ class MoM_T5(nn.Module):
                                    dtype=torch.float32)
             if self.fix_prefix_dim:
                 fixed_dims = [0 for _ in range(len(self.candidate_dims)-1)] + [1]
-                temp = torch.tensor(fixed_dims).unsqueeze(0).expand_as(self.arch_weights_multi_prefix).cuda()
+                temp = torch.tensor(fixed_dims).unsqueeze(0).expand_as(self.arch_weights_multi_prefix)
                 self.arch_weights_multi_prefix = temp.type_as(self.arch_weights_binary_prefix)
             else:
                 self.arch_weights_multi_prefix = nn.Parameter(
@@ -430,6 +423,8 @@ class MoM_T5(nn.Module):
                               lora_modules=[w_a_linear_o, w_b_linear_o], hidden_dim=d_model, candidate_dims=self.candidate_dims)
             attn.k = Mix_PEFT(attn.k, add_lora=self.use_lora, add_bitfit=self.use_bitfit, args=self.args,
                               lora_modules=[w_a_linear_k, w_b_linear_k], hidden_dim=d_model, candidate_dims=self.candidate_dims)
+            attn.group_qkv_lora = self.args.group_qkv_lora and self.use_lora
+            attn.attn_backend = self.args.attn_backend
             ffn.wi = Mix_PEFT(ffn.wi, add_lora=self.use_lora, add_bitfit=self.use_bitfit, args=self.args,
                               lora_modules=[w_a_linear_ffn1, w_b_linear_ffn1], hidden_dim=ffn_dim, candidate_dims=self.candidate_dims)
             ffn.wo = Mix_PEFT(ffn.wo, add_lora=self.use_lora, add_bitfit=self.use_bitfit, args=self.args,
@@ -483,6 +478,8 @@ class MoM_T5(nn.Module):
                               lora_modules=[w_a_linear_o, w_b_linear_o], hidden_dim=d_model, candidate_dims=self.candidate_dims)
             attn.k = Mix_PEFT(attn.k, add_lora=self.use_lora, add_bitfit=self.use_bitfit, args=self.args,
                               lora_modules=[w_a_linear_k, w_b_linear_k], hidden_dim=d_model, candidate_dims=self.candidate_dims)
+            attn.group_qkv_lora = self.args.group_qkv_lora and self.use_lora
+            attn.attn_backend = self.args.attn_backend
             ffn.wi = Mix_PEFT(ffn.wi, add_lora=self.use_lora, add_bitfit=self.use_bitfit, args=self.args, candidate_dims=self.candidate_dims,
                               lora_modules=[w_a_linear_ffn1, w_b_linear_ffn1], hidden_dim=ffn_dim)
             ffn.wo = Mix_PEFT(ffn.wo, add_lora=self.use_lora, add_bitfit=self.use_bitfit, args=self.args, candidate_dims=self.candidate_dims,
@@ -511,6 +508,12 @@ class MoM_T5(nn.Module):
 
         self.reset_parameters()
         self.t5_model = backbone
+        self.sparse_exec = self.args.sparse_exec
+        self.merged_shells, self.unwrapped = None, False
+        self.dispatch_plan = PEFTDispatchPlan() if self.use_search and self.args.dispatch_plan else None
+        self.t5_model.dispatch_plan = self.dispatch_plan
+        if self.use_search and (self.sparse_exec or self.dispatch_plan is not None):
+            self._assign_peft_slots()
 
         for name, param in self.t5_model.named_parameters():
             if "LoRA" in name or "LNfit" in name or "Adapter" in name or "BitFit" in name or "sadapter" in name or "padapter" in name or "prefix" in name:
@@ -519,6 +522,54 @@ class MoM_T5(nn.Module):
             else:
                 param.requires_grad = False
 
+    def _assign_peft_slots(self):
+        # (gumbel key, layer, slot) of every branch, following the slicing in t5_forward_mom
+        self.peft_slot_modules = []
+
+        branch_flags = {"lora": "add_lora", "bitfit": "add_bitfit", "lnfit": "add_lnfit", "adapter": "add_adapter",
+                        "sa": "add_SA", "pa": "add_PA"}
+
+        def assign(module, **slots):
+            module.peft_slots = {branch: slot for branch, slot in slots.items() if getattr(module, branch_flags[branch])}
+            module.dispatch_plan = self.dispatch_plan
+            self.peft_slot_modules.append(module)
+
+        for tag, blocks in [("encoder", self.t5_model.encoder.block), ("decoder", self.t5_model.decoder.block)]:
+            matrix, binary = tag, tag + "_binary"
+            for i, blk in enumerate(blocks):
+                attn_peft, ffn_peft = blk.layer[0].SelfAttention, blk.layer[-1].DenseReluDense
+                attn, ffn = attn_peft.original_module, ffn_peft.original_module
+                for slot, linear in enumerate([attn.q, attn.k, attn.v, attn.o]):
+                    assign(linear, lora=(matrix, i, slot), bitfit=(binary, i, slot))
+                assign(ffn.wi, lora=(matrix, i, 4), bitfit=(binary, i, 6))
+                # dense_forward hands the wi bitfit weights to wo as well
+                assign(ffn.wo, lora=(matrix, i, 5), bitfit=(binary, i, 6))
+                assign(attn_peft, adapter=(matrix, i, 6))
+                assign(ffn_peft, adapter=(matrix, i, 7), sa=(matrix, i, 8), pa=(matrix, i, 9))
+                assign(blk.layer[0].layer_norm, bitfit=(binary, i, 4), lnfit=(binary, i, 5))
+                assign(blk.layer[-1].layer_norm, bitfit=(binary, i, 8), lnfit=(binary, i, 9))
+                if tag == "decoder":
+                    assign(blk.layer[1].layer_norm, bitfit=(binary, i, 10), lnfit=(binary, i, 11))
+        assign(self.t5_model.encoder.final_layer_norm, bitfit=("final_norm", None, 0), lnfit=("final_norm", None, 1))
+        assign(self.t5_model.decoder.final_layer_norm, bitfit=("final_norm", None, 2), lnfit=("final_norm", None, 3))
+
+    def update_sparse_branches(self, gumbel_weights_all_dict):
+        # one host copy per gumbel tensor and step; a branch is skipped when all its "on" weights are zero
+        # same stage test as get_search_dims: without iter_search (iterative_order None) the matrix weights are
+        # dimension-stage samples, where index 0 is the smallest rank rather than "off"
+        binary_stage = self.iterative_order is not None and bool(self.iterative_order or self.main_forward)
+        active_masks = dict()
+        for key in ["encoder", "decoder", "encoder_binary", "decoder_binary", "final_norm"]:
+            weights = gumbel_weights_all_dict[key]
+            if weights is None:
+                continue
+            # candidate 0 is the "off" choice, except for the matrix weights at the dimension stage
+            on_start = 1 if "binary" in key or key == "final_norm" or binary_stage else 0
+            active = (weights[..., on_start:].detach() != 0).any(dim=-1).cpu().numpy()
+            active_masks[key] = (active, on_start)
+        for module in self.peft_slot_modules:
+            module.set_sparse_branches(active_masks)
+
     def arch_parameters(self):
         return self._arch_parameters
 
@@ -553,6 +604,7 @@ class MoM_T5(nn.Module):
             "final_norm_binary": self.final_norm_binary_mask,
             "prefix_binary": self.prefix_binary_mask
         }
+        self.pruned_modules = torch.tensor(self.prune_records_list, dtype=torch.bool, device=self.pruned_modules.device)
         for (idx, prune_flag) in enumerate(self.prune_records_list):
             (weight_matrix_name, layer, loc) = self.map_pruning_id_to_arch(idx)
             prune_status = self.prune_records_list[idx]
@@ -564,110 +616,156 @@ class MoM_T5(nn.Module):
             else:
                 weight_matrix_mask_dict[weight_matrix_name][loc] = prune_status
 
-    def update_grad(self):
-        #sensitivity records: self.exp_avg_grad_records_dict
-        #uncertainty records: self.exp_avg_unc_records_dict
-        # if self.use_prefix:
-        #     prefix_grad_dict = self.t5_model.prefix_module.upgrade_sub_grad()
+    @staticmethod
+    def sensitivity_module_name(name):
+        # the PEFT module a trainable parameter belongs to
+        sub_ = name.split(".")
+        if 'Adapter' in sub_[-2] or 'LoRA' in sub_[-2]:
+            return '.'.join(sub_[:-2])
+        elif 'prefix' in sub_[-2] and 'up' in sub_[-2] and 'gate' not in name:
+            return '.'.join(sub_[:-1])
+        elif 'sadapter' in sub_[-3] or 'padapter' in sub_[-3]:
+            return '.'.join(sub_[:-2])
+        return name
+
+    def _build_sensitivity_index(self):
+        # parameter -> module id, built once; per-parameter sums are index_added into [modules] vectors
+        params, param_module = [], []
         for name, param in self.t5_model.named_parameters():
-            # if "prefix" in name:
-            #     continue
-            if param.requires_grad:
-                sub_ = name.split(".")
-                parent_name = name
-                if 'gate' in name:
-                    continue
-                if 'Adapter' in sub_[-2] or 'LoRA' in sub_[-2]:
-                    parent_name = '.'.join(sub_[:-2])
-                elif 'prefix' in sub_[-2] and 'up' in sub_[-2] and 'gate' not in name:
-                    parent_name = '.'.join(sub_[:-1])
-                elif len(sub_) > 3 and 'sadapter' in sub_[-3] or 'padapter' in sub_[-3]:
-                    parent_name = '.'.join(sub_[:-2])
-                # if 'adapter' in sub_[-2] or 'Adapter' in sub_[-2] or 'LoRA' in sub_[-2]:
-                #     parent_name = '.'.join(sub_[:-2])
-                if self.prune_dict[parent_name] == False:
-                    new_grad = None
-                    new_grad_sum = None
-                    if param.grad is not None:
-                        new_grad = (param * param.grad).detach()
-                        if self.args.no_abs_grad:
-                            new_grad_sum = (-1) * new_grad.sum()
-                        else:
-                            new_grad_sum = new_grad.abs().sum()
-
-                    if new_grad is not None:
-                        if not self.main_forward:
-                            self.val_gradient_records_dict[parent_name].append(new_grad)
-                        else:
-                            self.gradient_records_dict[parent_name] += new_grad_sum
-                            self.train_gradient_records_dict[parent_name].append(new_grad)
-        # print('fnfk', self.gradient_records_dict)
-        val_gradients = list(self.val_gradient_records_dict.items())
-        train_gradients = list(self.train_gradient_records_dict.items())
-
-        flag_update = len(train_gradients[0][1]) > 0 and len(val_gradients[0][1]) > 0
-        if flag_update:
-            for i, (n, s) in enumerate(self.gradient_records_dict.items()):
-                # update the module gradient and prune records list
-                train_grad, val_grad = train_gradients[i][1], val_gradients[i][1]
-                grad_cos = []
-                val_gradient = torch.tensor(0, dtype=torch.float).cuda()
-                for j in range(len(train_grad)):
-                    cos = F.cosine_similarity(train_grad[j].flatten(), val_grad[j].flatten(), dim=0)
-                    grad_cos.append(cos)
-                    if self.args.no_abs_grad:
-                        val_gradient += -1 * val_grad[j].sum()
-                    else:
-                        val_gradient += val_grad[j].abs().sum()
-                avg_cos = 0
-                if len(grad_cos) > 0:
-                    avg_cos = sum(grad_cos) / len(grad_cos)
-                    # print(avg_cos,'cos')
-
-                module_id = self.module_id_dict[n]
-                prune_flag = self.prune_dict[n]
-                if self.args.prune_criterion == "tra":
-                    new_grad = self.gradient_records_dict[n] / self.param_scale_dict[n]
-                elif self.args.prune_criterion == "val":
-                    new_grad = val_gradient / self.param_scale_dict[n]
-                elif self.args.prune_criterion == "tra_val":
-                    new_grad = (self.gradient_records_dict[n] / self.param_scale_dict[n] + val_gradient / self.param_scale_dict[n])
-                elif self.args.prune_criterion == "tra_val_cos1":
-                    new_grad = self.gradient_records_dict[n] / self.param_scale_dict[n] + avg_cos * val_gradient / self.param_scale_dict[n]
-                else:
-                    new_grad = avg_cos * (self.gradient_records_dict[n] / self.param_scale_dict[n] + val_gradient / self.param_scale_dict[n])
-
-                self.gradient_records_dict[n] = torch.tensor(0, dtype=torch.float).cuda()
-                # if new_grad > 0: # consider the case that, the module is not selected, he gradient will be 0
-                self.exp_avg_grad_records_dict[n] = self.beta1 * self.exp_avg_grad_records_dict[n] + (1 - self.beta1) * new_grad
-                unc_step = (new_grad - self.exp_avg_grad_records_dict[n]).abs()
-                self.exp_avg_unc_records_dict[n] = self.beta2 * self.exp_avg_unc_records_dict[n] + (1 - self.beta2) * unc_step
-
-                # new_sensitivity = self.exp_avg_unc_records_dict[n] * self.exp_avg_grad_records_dict[n]
-                new_sensitivity = self.exp_avg_grad_records_dict[n]
-                # self.gradient_records_list[module_id] = s
-                self.gradient_records_list[module_id] = new_sensitivity
-                self.prune_records_list[module_id] = prune_flag
-                self.sen_records_dict[n] = new_sensitivity
-            # reset value
-            for n in self.train_gradient_records_dict:
-                self.train_gradient_records_dict[n] = []
-                self.val_gradient_records_dict[n] = []
+            if param.requires_grad and 'gate' not in name:
+                params.append(param)
+                param_module.append(self.module_id_dict[self.sensitivity_module_name(name)])
+        device = params[0].device
+        self.sensitivity_params = params
+        self.param_module_index = torch.tensor(param_module, dtype=torch.long, device=device)
+        self.param_numel = torch.tensor([p.numel() for p in params], dtype=torch.long, device=device)
+        self.param_start = self.param_numel.cumsum(0) - self.param_numel
+        # count-sketch bucket and sign come from one hash of the element position in the full parameter layout,
+        # derived at use time, so train/val gradients are compared through [params, sketch_dim] signatures
+        # without any per-element state
+        self.sketch_dim = max(self.args.grad_sketch_dim, 1)
+        generator = torch.Generator().manual_seed(0)
+        self.sketch_hash = torch.randint(1, SKETCH_HASH_PRIME, (2,), generator=generator).tolist()
+        self.align_grads = self.args.prune_criterion in ['tra_val_cos1', 'tra_val_cos2']
+        self.param_scale_vector = torch.tensor([float(self.param_scale_dict[self.id_module_dict[i]]) for i in range(self.modules_number)], device=device)
+        self.train_sensitivity = torch.zeros(self.modules_number, device=device)
+        self.exp_avg_grad = torch.zeros(self.modules_number, device=device)
+        self.exp_avg_unc = torch.zeros(self.modules_number, device=device)
+        self.val_grad_record = None  # (sketch, norms, sums, recorded params) of the pending arch step
+
+    def _module_sums(self, values):
+        # [params] -> [modules]
+        return values.new_zeros(self.modules_number).index_add_(0, self.param_module_index, values)
+
+    def _param_values(self, values, present):
+        # values of the parameters with a gradient -> [params], zero for the others
+        return values.new_zeros(len(self.sensitivity_params)).index_copy_(0, present, values)
+
+    def _flat_param_ids(self, present, numel):
+        # parameter id of every element of the concatenated products, built per call
+        return torch.repeat_interleave(present, self.param_numel[present], output_size=numel)
+
+    def _signed_sums(self, products, flat, present):
+        # [params] sensitivity sums of the per-parameter param * grad: l1 norms, or negated sums for no_abs_grad
+        if self.args.no_abs_grad:
+            return -flat.new_zeros(len(self.sensitivity_params)).index_add_(0, self._flat_param_ids(present, flat.numel()), flat)
+        return self._param_values(torch.stack(torch._foreach_norm(products, 1)).float(), present)
+
+    def _l2_norms(self, products, present):
+        return self._param_values(torch.stack(torch._foreach_norm(products)).float(), present)
+
+    def _grad_sketch(self, flat, present):
+        # count sketch of every parameter's param * grad: sketch(a) . sketch(b) is an unbiased estimate of a . b.
+        # one pass over the concatenated products: h = (a * position + b) mod p of the element position in the
+        # full layout gives the sign (lowest bit) and the bucket (the rest) inside the parameter's sketch_dim slots
+        param_ids = self._flat_param_ids(present, flat.numel())
+        lengths = self.param_numel[present]
+        shift = self.param_start[present] - (lengths.cumsum(0) - lengths)
+        a, b = self.sketch_hash
+        hashes = torch.arange(flat.numel(), device=flat.device).add_(shift[param_ids]).mul_(a).add_(b).remainder_(SKETCH_HASH_PRIME)
+        signed = torch.where(hashes.bitwise_and(1).bool(), flat, -flat)
+        index = param_ids.mul_(self.sketch_dim).add_(hashes.div_(2, rounding_mode='floor').remainder_(self.sketch_dim))
+        num_params = len(self.sensitivity_params)
+        return flat.new_zeros(num_params * self.sketch_dim).index_add_(0, index, signed).view(num_params, -1)
+
+    @torch.no_grad()
+    def update_grad(self):
+        # sensitivity: |param * grad| summed per module on the train steps, aligned (cosine) with the arch step
+        # gradients of the same parameters; EMA (exp_avg_grad) and uncertainty (exp_avg_unc) are [modules] vectors
+        if self.param_module_index is None:
+            self._build_sensitivity_index()
+        device = self.param_module_index.device
+        self.pruned_modules = self.pruned_modules.to(device)
+        # skipped branches (sparse execution) may leave a step without gradient; those parameters are left out
+        # of the products and masked by has_grad
+        present = [i for i, p in enumerate(self.sensitivity_params) if p.grad is not None]
+        if not present:
+            return
+        params = [self.sensitivity_params[i] for i in present]
+        present = torch.tensor(present, dtype=torch.long, device=device)
+        has_grad = torch.zeros(len(self.sensitivity_params), dtype=torch.bool, device=device).index_fill_(0, present, True)
+        products = torch._foreach_mul(params, [p.grad for p in params])
+        flat = torch.cat([t.reshape(-1) for t in products]).float() if self.args.no_abs_grad or self.align_grads else None
+        recorded = has_grad & ~self.pruned_modules[self.param_module_index]
+
+        if not self.main_forward:
+            if self.val_grad_record is None:
+                # only O(params * sketch_dim) is kept until the train step, not the products
+                sketch = self._grad_sketch(flat, present) if self.align_grads else None
+                norms = self._l2_norms(products, present) if self.align_grads else None
+                self.val_grad_record = (sketch, norms, self._signed_sums(products, flat, present), recorded)
+            return
+        self.train_sensitivity += self._module_sums(self._signed_sums(products, flat, present) * recorded)
+        if self.val_grad_record is None:
+            return
+
+        val_sketch, val_norms, val_sums, val_recorded = self.val_grad_record
+        paired = (recorded & val_recorded).float()
+        val_gradient = self._module_sums(val_sums * paired)
+        avg_cos = None
+        if self.align_grads:
+            eps = 1e-8
+            dots = (self._grad_sketch(flat, present) * val_sketch).sum(-1)
+            norms = self._l2_norms(products, present)
+            cos = (dots / (norms.clamp(min=eps) * val_norms.clamp(min=eps))).clamp(-1, 1)
+            avg_cos = self._module_sums(cos * paired) / self._module_sums(paired).clamp(min=1)
+
+        train_grad, val_grad = self.train_sensitivity / self.param_scale_vector, val_gradient / self.param_scale_vector
+        if self.args.prune_criterion == "tra":
+            new_grad = train_grad
+        elif self.args.prune_criterion == "val":
+            new_grad = val_grad
+        elif self.args.prune_criterion == "tra_val":
+            new_grad = train_grad + val_grad
+        elif self.args.prune_criterion == "tra_val_cos1":
+            new_grad = train_grad + avg_cos * val_grad
+        else:
+            new_grad = avg_cos * (train_grad + val_grad)
+
+        self.exp_avg_grad = self.beta1 * self.exp_avg_grad + (1 - self.beta1) * new_grad
+        unc_step = (new_grad - self.exp_avg_grad).abs()
+        self.exp_avg_unc = self.beta2 * self.exp_avg_unc + (1 - self.beta2) * unc_step
+        # new_sensitivity = self.exp_avg_unc * self.exp_avg_grad
+        self.gradient_records_list = self.exp_avg_grad
+        # reset value
+        self.train_sensitivity = torch.zeros_like(self.train_sensitivity)
+        self.val_grad_record = None
+
+    def sensitivity_records(self):
+        if self.gradient_records_list is None:
+            return dict()
+        return dict(zip([self.id_module_dict[i] for i in range(self.modules_number)], self.gradient_records_list.tolist()))
 
     def select_top_gradient_modules(self, budget):
         param_number_list = self.param_scale_list
-        gradients = self.gradient_records_list
-        if None in gradients:
+        if self.gradient_records_list is None:
             return None
-        gradients_mask = [
-            torch.tensor(-999, dtype=torch.float).cuda() if i else torch.tensor(0, dtype=torch.float).cuda() for i
-            in self.prune_records_list]
-        masked_gradients = [a + b for a, b in zip(gradients, gradients_mask)]
+        masked_gradients = (self.gradient_records_list - 999 * self.pruned_modules.float()).tolist()
         # add other modules later
         param_numbers = param_number_list
         # Pair module index with gradient and number of parameters, then sort by gradient descending
         modules = sorted(enumerate(zip(masked_gradients, param_numbers)), key=lambda x: x[1][0], reverse=True)
-        selected_modules = [0] * len(gradients)  # Initialize the one-hot list for selected modules
+        selected_modules = [0] * len(masked_gradients)  # Initialize the one-hot list for selected modules
         current_budget = 0
 
         for idx, (gradient, param_number) in modules:
@@ -755,7 +853,7 @@ class MoM_T5(nn.Module):
             if 'lora' in n or 'adapter' in n:
                 layer_id, encoder_flag, final_layer_norm_flag, matrix_flag, loc = recognize_layer_id(n)
                 if not encoder_flag:
-                    layer_id += 24
+                    layer_id += self.num_encoder_layers
                 new_param_scale = matrix_param_and_weight[layer_id, loc]
                 module_id = self.module_id_dict[n]
                 self.param_scale_list[module_id] = new_param_scale.item()
@@ -767,7 +865,7 @@ class MoM_T5(nn.Module):
         self.max_prune_step -= 1
         print(f"budget: {self.budget_abs}, current expectation: {all_expected_params}, pruned: {params_pruned}")
 
-        gradients = [i.cpu().item() for i in self.gradient_records_list]
+        gradients = self.gradient_records_list.tolist()
         gradients_mask = [999 if i == True else 0 for i in self.prune_records_list]
         masked_gradients = [a + b for a, b in zip(gradients, gradients_mask)]
 
@@ -812,7 +910,7 @@ class MoM_T5(nn.Module):
             ideal_shape = self.arch_weights_multi_encoder[..., :2]
             while weight_all.dim() < ideal_shape.dim():
                 weight_all = weight_all.unsqueeze(0)
-                weight_all = weight_all.expand_as(ideal_shape).cuda()
+                weight_all = weight_all.expand_as(ideal_shape).to(ideal_shape.device)
             arch_weights_binary_encoder_matrix = weight_all.clone()
             arch_weights_binary_decoder_matrix = weight_all.clone()
         arch_weights_binary_prefix = self.arch_weights_binary_prefix
@@ -847,8 +945,8 @@ class MoM_T5(nn.Module):
             if self.early_stop:
                 prefix_binary_mask = arch_weights_binary_prefix
             _, prefix_max_dim = torch.max(arch_weights_multi_prefix, dim=-1)
-            prefix_dimension_mask = prefix_max_dim.cuda()
-            backbone.prefix_module.freeze_arch(finalized_weight={"binary":prefix_binary_mask.cuda(), "dim":prefix_dimension_mask}
+            prefix_dimension_mask = prefix_max_dim.to(backbone.device)
+            backbone.prefix_module.freeze_arch(finalized_weight={"binary":prefix_binary_mask.to(backbone.device), "dim":prefix_dimension_mask}
                                                , retrain_flag=self.retrain)
 
         for t_layer_i, blk in enumerate(backbone.encoder.block):
@@ -1035,6 +1133,7 @@ class MoM_T5(nn.Module):
         }
         backbone.encoder.final_layer_norm.freeze_arch(finalized_weight=encoder_norm_weight, retrain_flag=self.retrain)
         backbone.decoder.final_layer_norm.freeze_arch(finalized_weight=decoder_norm_weight, retrain_flag=self.retrain)
+        clear_prefix_cache(backbone)
 
         for name, param in self.t5_model.named_parameters():
             if "LoRA" in name or "LNfit" in name or "Adapter" in name or "BitFit" in name or "sadapter" in name or "padapter" in name or "prefix" in name:
@@ -1044,6 +1143,46 @@ class MoM_T5(nn.Module):
             else:
                 param.requires_grad = False
 
+    def _peft_shells(self):
+        # (parent, attribute, Mix_PEFT) of every wrapped module
+        shells = []
+        for name, module in self.t5_model.named_modules():
+            if isinstance(module, Mix_PEFT):
+                parent_name, _, attr = name.rpartition('.')
+                shells.append((self.t5_model.get_submodule(parent_name), attr, module))
+        return shells
+
+    def merge_peft(self):
+        # for inference after finalize_arch: fold the selected LoRA/BitFit/LNfit into the frozen T5 weights.
+        # when only those were selected (no adapters, no prefix, no norm bitfit) the Mix_PEFT shells are removed
+        # and the transformers forwards restored, otherwise the folded shells stay and only skip their branches
+        if self.merged_shells is not None:
+            return
+        shells = self._peft_shells()
+        for _, _, shell in shells:
+            if shell.mergeable():
+                shell.merge()
+        self.merged_shells, self.unwrapped = shells, False
+        if all(shell.merged and shell.merged_bias is None for _, _, shell in shells) and not hasattr(self.t5_model, "prefix_module"):
+            for parent, attr, shell in shells:
+                setattr(parent, attr, shell.original_module)
+            reset_forward(self.t5_model)
+            self.unwrapped = True
+
+    def unmerge_peft(self):
+        if self.merged_shells is None:
+            return
+        if self.unwrapped:
+            # the PEFT forwards are bound to the inner attention/ffn modules, so install them before re-wrapping
+            if self.use_search or self.use_prefix:
+                set_lora_forward(self.t5_model)
+            for parent, attr, shell in self.merged_shells:
+                setattr(parent, attr, shell)
+        for _, _, shell in self.merged_shells:
+            if shell.merged:
+                shell.unmerge()
+        self.merged_shells, self.unwrapped = None, False
+
     def modify_arch_mask(self, binary_stage=True):
         if binary_stage: #binary search stage
             dimension_weights_encoder = self.arch_weights_multi_encoder
@@ -1100,6 +1239,7 @@ class MoM_T5(nn.Module):
         print("change the binary arch weights with the pruning result for evaluation")
 
     def init_gumbel_weights(self, epochs=100, eval_mode=False):
+        device = self.t5_model.device
         if self.iter_search:
             arch_weights_binary_encoder_matrix = self.arch_weights_binary_encoder_matrix
             arch_weights_binary_decoder_matrix = self.arch_weights_binary_decoder_matrix
@@ -1187,21 +1327,21 @@ class MoM_T5(nn.Module):
                                                                      early_stop=self.early_stop, dim_stage=True,
                                                                      binary_mask=binary_mask_prefix, no_gumbel=self.no_gumbel)
                     elif self.fix_prefix_dim:
-                        gumbel_weights_prefix = arch_weights_multi_prefix
+                        gumbel_weights_prefix = arch_weights_multi_prefix.to(device)
                                                                     # in shape [layers, opsitions, dimensions]
                     if self.early_stop:
                         max_weights_encoder_matrix = self.get_max_weight(arch_weights_multi_encoder)
                         max_weights_decoder_matrix = self.get_max_weight(arch_weights_multi_decoder) # max_weights in shape [layers, opsitions]
                         if self.dimension_fix_mask is not None:
-                            inverted_dimension_mask = (1 - self.dimension_fix_mask.cuda())
+                            inverted_dimension_mask = (1 - self.dimension_fix_mask.to(device))
                             # [layers, modules, 1] * [layers, modules, 3(candidates)]
-                            gumbel_weights_encoder_matrix = self.dimension_fix_mask[:self.num_encoder_layers].unsqueeze(-1).cuda() * max_weights_encoder_matrix + inverted_dimension_mask[:self.num_encoder_layers].unsqueeze(-1) * gumbel_weights_encoder_matrix
-                            gumbel_weights_decoder_matrix = self.dimension_fix_mask[self.num_encoder_layers:].unsqueeze(-1).cuda() * max_weights_decoder_matrix + inverted_dimension_mask[self.num_encoder_layers:].unsqueeze(-1) * gumbel_weights_decoder_matrix
+                            gumbel_weights_encoder_matrix = self.dimension_fix_mask[:self.num_encoder_layers].unsqueeze(-1).to(device) * max_weights_encoder_matrix + inverted_dimension_mask[:self.num_encoder_layers].unsqueeze(-1) * gumbel_weights_encoder_matrix
+                            gumbel_weights_decoder_matrix = self.dimension_fix_mask[self.num_encoder_layers:].unsqueeze(-1).to(device) * max_weights_decoder_matrix + inverted_dimension_mask[self.num_encoder_layers:].unsqueeze(-1) * gumbel_weights_decoder_matrix
                         encoder_matrix_binary_mask, decoder_matrix_binary_mask = self.encoder_matrix_binary_mask, self.decoder_matrix_binary_mask
-                        gumbel_weights_encoder_matrix = encoder_matrix_binary_mask.unsqueeze(-1).cuda() * gumbel_weights_encoder_matrix
-                        gumbel_weights_decoder_matrix = decoder_matrix_binary_mask.unsqueeze(-1).cuda() * gumbel_weights_decoder_matrix
+                        gumbel_weights_encoder_matrix = encoder_matrix_binary_mask.unsqueeze(-1).to(device) * gumbel_weights_encoder_matrix
+                        gumbel_weights_decoder_matrix = decoder_matrix_binary_mask.unsqueeze(-1).to(device) * gumbel_weights_decoder_matrix
                         if self.use_prefix:
-                            gumbel_weights_prefix = self.prefix_binary_mask.unsqueeze(-1).cuda() * gumbel_weights_prefix.cuda()
+                            gumbel_weights_prefix = self.prefix_binary_mask.unsqueeze(-1).to(device) * gumbel_weights_prefix.to(device)
                 gumbel_weights_encoder_binary = bernoulli_sample(arch_weights_binary_encoder, temp=temp, early_stop=self.early_stop, binary_prune_mask=self.encoder_vector_binary_mask, no_gumbel=self.no_gumbel)
                 gumbel_weights_decoder_binary = bernoulli_sample(arch_weights_binary_decoder, temp=temp, early_stop=self.early_stop, binary_prune_mask=self.decoder_vector_binary_mask, no_gumbel=self.no_gumbel)
             else:
@@ -1250,7 +1390,7 @@ class MoM_T5(nn.Module):
                 fix_indices = self.fix_dimensions()
                 # print("Fixed modules at this round", fix_indices)
                 print("Pruned modules at this round", pruned_names)
-                print("Pruned gradients: ", [self.gradient_records_list[id_] for id_ in pruned_idx])
+                print("Pruned gradients: ", [self.gradient_records_list[id_].item() for id_ in pruned_idx])
                 self.prune_flag = False
 
         # stop pruning and finalize the arch
@@ -1258,7 +1398,7 @@ class MoM_T5(nn.Module):
             print("Finally selected modules", [self.id_module_dict[idw] for idw in range(self.modules_number) if
                                                self.prune_records_list[idw] == False])
             self.replace_binary_weights()
-            print("gradients records", self.sen_records_dict)
+            print("gradients records", self.sensitivity_records())
 
     def forward(self, x, cur_epoch, eval_mode=False, main_forward=False) -> Tensor:
         self.main_forward = main_forward # main_forward: it means that this is not the forward for the "arch search"
@@ -1276,10 +1416,20 @@ class MoM_T5(nn.Module):
             }
             if not self.iter_search:
                 self.iterative_order = None
+            if self.sparse_exec:
+                self.update_sparse_branches(gumbel_weights_all_dict)
+            if self.dispatch_plan is not None:
+                self.dispatch_plan.update(gumbel_weights_all_dict, dimension_mask,
+                                          iterative_order=self.iterative_order, main_forward=self.main_forward)
             # if self.no_gumbel:
             #     print(gumbel_weights_all_dict)
-            loss = self.t5_model(**x, gumbel_weights=gumbel_weights_all_dict, dimension_mask=dimension_mask,
-                                 iterative_order=self.iterative_order, main_forward=self.main_forward)
+            try:
+                loss = self.t5_model(**x, gumbel_weights=gumbel_weights_all_dict, dimension_mask=dimension_mask,
+                                     iterative_order=self.iterative_order, main_forward=self.main_forward)
+            finally:
+                # a forward that raises must not leave stale slot weights for the next plain forward
+                if self.dispatch_plan is not None:
+                    self.dispatch_plan.clear()
             if not self.main_forward and self.iter_search:
                 self.iterative_order = not self.iterative_order
             if self.dim_then_binary or self.binary_then_dim:
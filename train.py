@@ -20,7 +20,9 @@ from transformers import AutoTokenizer, set_seed
 from transformers.models.t5.modeling_t5 import T5Config, T5ForConditionalGeneration
 from transformers.optimization import get_linear_schedule_with_warmup
 
-from space.mom_s3delta import MoM_T5, weights
+from space.t5_search_space import MoM_T5, weights
+from space.static_model import build_static_model
+from space.forward_injection import compile_blocks, graph_break_report
 
 import utils.misc as misc
 from utils.misc import NativeScalerWithGradNormCount as NativeScaler
@@ -124,6 +126,7 @@ def get_args_parser():
     parser.add_argument('--prune_threshold', type=float, default=0.85,
                         help='stability-based pruning threshold (default: 0.85)')
     parser.add_argument('--no_abs_grad', action='store_true', help='the other choice for gradient')
+    parser.add_argument('--grad_sketch_dim', default=256, type=int, help='count-sketch size per parameter for the train/val gradient cosine of the tra_val_cos criteria')
     parser.add_argument('--split_train_data', action='store_true', help='whether to split training data')
 
     parser.add_argument('--iter_search', action='store_true', help='whether to use iterative search')
@@ -141,15 +144,26 @@ def get_args_parser():
     parser.add_argument('--small_prefix', action='store_true', help='whether using smaller prefix search space')
     parser.add_argument('--zero_lr_adapter', action='store_true', help='whether using zero-initialization for low-rank adapter')
     parser.add_argument('--fix_prefix_dim', action='store_true', help='whether to fix prefix dim, because the parameters of prefix is decided by the MLP(locations), not the length of prefix')
+    parser.add_argument('--sparse_exec', action='store_true', help='whether to skip PEFT branches whose sampled gumbel weights switch them off')
+    parser.add_argument('--group_qkv_lora', action='store_true', help='whether to run the q/k/v LoRA branches as one grouped projection during search')
+    parser.add_argument('--attn_backend', default='eager', type=str, choices=['eager', 'sdpa'], help='self-attention kernel: the explicit softmax, or scaled_dot_product_attention with the relative bias as additive mask')
+    parser.add_argument('--dispatch_plan', action='store_true', help='whether to hand the sampled gumbel weights to the PEFT modules through a per-step slot plan instead of per-block dicts')
+    parser.add_argument('--int8_backbone', default='none', type=str, choices=['none', 'weight', 'dynamic'], help='store the frozen q/k/v/o/wi/wo linears in int8: dequantized on the fly, or with the dynamic int8 kernel for cpu inference')
+    parser.add_argument('--compile_blocks', action='store_true', help='whether to torch.compile every T5 block forward')
+    parser.add_argument('--compile_report', action='store_true', help='print the graphs/graph breaks torch.compile finds in one training forward before training')
+    parser.add_argument('--static_model', action='store_true', help='whether to retrain the finalized architecture as a static module tree without the search scaffolding')
 
     # ablation
     parser.add_argument('--binary_then_dim', action='store_true', help="ablation study: binary search then dimension search")
     parser.add_argument('--dim_then_binary', action='store_true')
     parser.add_argument('--no_gumbel', action='store_true', help="not using gumbel-softmax for ablation study")
 
+    parser.add_argument('--device', default=None, type=str, help='device to search/train on, defaults to cuda when available')
+    parser.add_argument('--num_threads', default=0, type=int, help='intra-op threads for cpu execution, 0 keeps the torch default')
     parser.add_argument('--amp', action='store_true')
     parser.add_argument('--no-amp', action='store_false', dest='amp')
     parser.add_argument('--test_module', action='store_true')
+    parser.add_argument('--label_scoring', action='store_true', help='evaluate tasks with a fixed label set by scoring every label instead of generating')
 
     return parser
 
@@ -159,7 +173,9 @@ def main(args):
     print('job dir: {}'.format(os.path.dirname(os.path.realpath(__file__))))
     print("{}".format(args).replace(', ', ',\n'))
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
     logging.info(args)
 
     # Set seed before initializing model.
@@ -335,7 +351,7 @@ def main(args):
     max_step = args.epochs * len(train_dataloader)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=0, num_training_steps=max_step)
 
-    scaler = NativeScaler()
+    scaler = NativeScaler(enabled=device.type == 'cuda')
     model, arch_optimizer, optimizer_loaded, loss_scaler_loaded = misc.load_model(args=args, model_without_ddp=model_without_ddp, arch_optimizer=None, optimizer=optimizer, loss_scaler=scaler)
     if not args.retrain_all:
         optimizer = optimizer_loaded
@@ -357,6 +373,9 @@ def main(args):
     #before retraining or search
     if args.retrain:
         model.finalize_arch()
+        if args.static_model:
+            model = build_static_model(model)
+            model_without_ddp = model
         num_params = 0
         for (n, p) in model.named_parameters():
             if 'arch' in n:
@@ -369,6 +388,13 @@ def main(args):
         all_num_params = sum(p.numel() for p in model.parameters())
         print(f"all params: {all_num_params}, trainable params: {num_params}")
 
+    if args.compile_blocks:
+        compile_blocks(model.t5_model)
+    if args.compile_report:
+        report_input = next(iter(train_dataloader))
+        report_input['decoder_input_ids'] = model.t5_model._shift_right(report_input['labels'])
+        graph_break_report(model, {k: v.to(device) for k, v in report_input.items()})
+
     if args.test_module:
         args.start_epoch = args.epochs
 
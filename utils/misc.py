@@ -38,7 +38,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=reduce_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -246,8 +246,8 @@ def init_distributed_mode(args):
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled)
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
@@ -453,10 +453,17 @@ def save_prune_model(args, epoch, model, model_without_ddp, optimizer, arch_opti
         }
         save_on_master(to_save, checkpoint_path)
 
+def reduce_device():
+    # nccl only reduces cuda tensors, gloo (cpu runs) reduces host tensors
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
 def all_reduce_mean(x):
     world_size = get_world_size()
     if world_size > 1:
-        x_reduce = torch.tensor(x).cuda()
+        x_reduce = torch.tensor(x, device=reduce_device())
         dist.all_reduce(x_reduce)
         x_reduce /= world_size
         return x_reduce.item()